@@ -1,15 +1,19 @@
 import copy
 import json
-from typing import Iterable, Dict, Any
+from typing import TYPE_CHECKING, Iterable, Dict, Any
 
 import streamlit as st
 from streamlit_ace import st_ace
-from groq import Groq
 
-from moa.agent import MOAgent
-from moa.agent.moa import ResponseChunk, MOAgentConfig
+# LangChain and the Groq SDK are only loaded once an agent is built
+from moa.agent import ResponseChunk, MOAgentConfig
+from moa.agent.catalog import get_model_catalog
+from moa.agent.registry import get_registry
 from moa.agent.prompts import SYSTEM_PROMPT, REFERENCE_SYSTEM_PROMPT
 
+if TYPE_CHECKING:
+    from moa.agent import MOAgent
+
 # Default configuration
 default_main_agent_config = {
     "main_model": "llama3-70b-8192",
@@ -82,26 +86,24 @@ def json_to_moa_config(config_file) -> Dict[str, Any]:
         'moa_main_agent_config': moa_config or None
     }
 
-def stream_response(messages: Iterable[ResponseChunk]):
-    layer_outputs = {}
+def stream_response(messages: Iterable[ResponseChunk], num_agents: int = 1):
+    layer_columns = {}
     for message in messages:
         if message['response_type'] == 'intermediate':
+            # Render each layer agent's output as soon as it arrives
             layer = message['metadata']['layer']
-            if layer not in layer_outputs:
-                layer_outputs[layer] = []
-            layer_outputs[layer].append(message['delta'])
-        else:
-            # Display accumulated layer outputs
-            for layer, outputs in layer_outputs.items():
+            if layer not in layer_columns:
                 st.write(f"Layer {layer}")
-                cols = st.columns(len(outputs))
-                for i, output in enumerate(outputs):
-                    with cols[i]:
-                        st.expander(label=f"Agent {i+1}", expanded=False).write(output)
-            
-            # Clear layer outputs for the next iteration
-            layer_outputs = {}
-            
+                layer_columns[layer] = iter(st.columns(num_agents))
+            col = next(layer_columns[layer], None)
+            if col is None:
+                col = st.columns(1)[0]
+            with col:
+                if message['metadata'].get('cutoff'):
+                    st.caption(f"{message['metadata']['agent']} timed out")
+                else:
+                    st.expander(label=message['metadata']['agent'], expanded=False).write(message['delta'])
+        else:
             # Yield the main agent's output
             yield message['delta']
 
@@ -119,20 +121,26 @@ def set_moa_agent(
     if "moa_layer_agent_config" not in st.session_state or override:
         st.session_state.moa_layer_agent_config = moa_layer_agent_config
 
-    if override or ("moa_agent" not in st.session_state):
-        st_main_copy = copy.deepcopy(st.session_state.moa_main_agent_config)
-        st_layer_copy = copy.deepcopy(st.session_state.moa_layer_agent_config)
-        st.session_state.moa_agent = MOAgent.from_config(
-            **st_main_copy,
-            layer_agent_config=st_layer_copy
-        )
-
-        del st_main_copy
-        del st_layer_copy
+    if override:
+        # Built right away so that an invalid configuration is reported by the form
+        st.session_state.moa_agent = build_moa_agent()
 
     del moa_main_agent_config
     del moa_layer_agent_config
 
+def build_moa_agent() -> "MOAgent":
+    # Sessions with the same configuration share one compiled pipeline; each gets its own memory
+    return get_registry().get({
+        **st.session_state.moa_main_agent_config,
+        'layer_agent_config': st.session_state.moa_layer_agent_config
+    })
+
+def get_moa_agent() -> "MOAgent":
+    # Built on first use, so the page renders before LangChain and the Groq SDK are loaded
+    if "moa_agent" not in st.session_state:
+        st.session_state.moa_agent = build_moa_agent()
+    return st.session_state.moa_agent
+
 # App
 st.set_page_config(
     page_title="Mixture-Of-Agents Powered by Groq",
@@ -143,7 +151,8 @@ st.set_page_config(
     layout="wide"
 )
 
-valid_model_names = [model.id for model in Groq().models.list().data if not (model.id.startswith("whisper") or model.id.startswith("llama-guard"))]
+# Served from memory or disk on reruns; the API is queried at most once an hour
+valid_model_names = get_model_catalog().models()
 
 st.markdown("<a href='https://groq.com'><img src='app/static/banner.png' width='500'></a>", unsafe_allow_html=True)
 st.write("---")
@@ -336,10 +345,13 @@ if query := st.chat_input("Ask a question"):
     with st.chat_message("user"):
         st.write(query)
 
-    moa_agent: MOAgent = st.session_state.moa_agent
+    moa_agent = get_moa_agent()
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
-        ast_mess = stream_response(moa_agent.chat(query, output_format='json'))
+        ast_mess = stream_response(
+            moa_agent.chat(query, output_format='json', stream_layers=True),
+            num_agents=len(st.session_state.moa_layer_agent_config)
+        )
         response = st.write_stream(ast_mess)
     
     st.session_state.messages.append({"role": "assistant", "content": response})
\ No newline at end of file
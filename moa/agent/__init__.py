@@ -1 +1,14 @@
-from .moa import MOAgent
\ No newline at end of file
+from typing import TYPE_CHECKING, Any
+
+from .types import MOAgentConfig, ResponseChunk
+
+if TYPE_CHECKING:
+    from .moa import MOAgent
+
+
+def __getattr__(name: str) -> Any:
+    # Importing MOAgent loads LangChain, so defer it until it's actually used
+    if name == 'MOAgent':
+        from .moa import MOAgent
+        return MOAgent
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
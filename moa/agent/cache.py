@@ -0,0 +1,239 @@
+"""
+Response caches for agent chains
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import aclosing, closing
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from .instrumentation import mark_call, record_event
+
+
+class BaseCache(ABC):
+    """Maps a request key to a previously generated completion."""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: str) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+
+class InMemoryCache(BaseCache):
+    """Thread-safe LRU cache with an optional time-to-live in seconds."""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created, value = entry
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCache(BaseCache):
+    """On-disk cache, evicting the least recently used rows beyond ``maxsize``."""
+
+    def __init__(
+        self,
+        path: str = "moa_cache.db",
+        ttl: Optional[float] = None,
+        maxsize: Optional[int] = None
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self.ttl is not None and now - created > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            if self.maxsize is not None:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key NOT IN "
+                    "(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)",
+                    (self.maxsize,)
+                )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+
+_default_cache: Optional[InMemoryCache] = None
+
+
+def get_default_cache() -> InMemoryCache:
+    """Process-wide in-memory cache shared by agents configured with ``response_cache: true``."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = InMemoryCache()
+    return _default_cache
+
+
+def cache_from_config(spec: Optional[BaseCache | Dict[str, Any] | bool]) -> Optional[BaseCache]:
+    """Resolve a ``response_cache`` config value.
+
+    Accepts a cache instance, ``True`` for the shared in-memory cache, or a dict such as
+    ``{"backend": "sqlite", "path": "moa_cache.db", "ttl": 3600}``.
+    """
+    if spec is None or spec is False:
+        return None
+    if spec is True:
+        return get_default_cache()
+    if isinstance(spec, BaseCache):
+        return spec
+
+    spec = dict(spec)
+    backend = spec.pop("backend", "memory")
+    if backend == "memory":
+        return InMemoryCache(**spec)
+    if backend == "sqlite":
+        return SQLiteCache(**spec)
+    raise ValueError(f"Unknown response cache backend: {backend}")
+
+
+def cache_key(params: Dict[str, Any], prompt: PromptValue) -> str:
+    """Hash the model parameters together with the fully rendered prompt messages."""
+    payload = json.dumps(
+        {
+            'params': params,
+            'messages': [[m.type, m.content] for m in prompt.to_messages()]
+        },
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class CachedRunnable(Runnable[PromptValue, str]):
+    """Wraps an ``llm | StrOutputParser()`` runnable with a response cache.
+
+    ``params`` identifies the model and its sampling arguments; together with the
+    rendered prompt it forms the cache key. Streams are replayed as a single chunk
+    on a hit and only stored once they have completed.
+    """
+
+    def __init__(self, bound: Runnable[PromptValue, str], cache: BaseCache, params: Dict[str, Any]) -> None:
+        self.bound = bound
+        self.cache = cache
+        self.params = params
+
+    def _hit(self, config: Optional[RunnableConfig]) -> None:
+        record_event(config, 'cache_hit', model=self.params.get('model'))
+        mark_call(config, cache_hit=True)
+
+    def invoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        key = cache_key(self.params, input)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self._hit(config)
+            return cached
+        output = self.bound.invoke(input, config, **kwargs)
+        self.cache.set(key, output)
+        return output
+
+    async def ainvoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        key = cache_key(self.params, input)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self._hit(config)
+            return cached
+        output = await self.bound.ainvoke(input, config, **kwargs)
+        self.cache.set(key, output)
+        return output
+
+    def stream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[str]:
+        key = cache_key(self.params, input)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self._hit(config)
+            yield cached
+            return
+        output = ""
+        with closing(self.bound.stream(input, config, **kwargs)) as stream:
+            for chunk in stream:
+                output += chunk
+                yield chunk
+        self.cache.set(key, output)
+
+    async def astream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[str]:
+        key = cache_key(self.params, input)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self._hit(config)
+            yield cached
+            return
+        output = ""
+        async with aclosing(self.bound.astream(input, config, **kwargs)) as stream:
+            async for chunk in stream:
+                output += chunk
+                yield chunk
+        self.cache.set(key, output)
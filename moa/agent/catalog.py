@@ -0,0 +1,112 @@
+"""
+Cached catalog of the chat models available on Groq
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, List, Optional, get_args
+
+from .types import valid_model_names
+
+# Audio and moderation models can't act as agents
+EXCLUDED_MODEL_PREFIXES = ('whisper', 'llama-guard')
+
+
+def fetch_groq_models(timeout: float = 5.0) -> List[str]:
+    """Chat model ids from the Groq API."""
+    from dotenv import load_dotenv
+    from groq import Groq
+
+    load_dotenv()
+    models = Groq(timeout=timeout, max_retries=0).models.list().data
+    return sorted(model.id for model in models if not model.id.startswith(EXCLUDED_MODEL_PREFIXES))
+
+
+class ModelCatalog:
+    """Model ids, refreshed from the API at most once per ``ttl`` seconds.
+
+    The last successful listing is kept in memory and persisted to ``path`` so a
+    fresh process starts without a network call. When the API can't be reached
+    the stale listing is served, and without one the static
+    ``valid_model_names`` are.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 3600,
+        path: Optional[str] = os.path.join(os.path.expanduser("~"), ".cache", "moa", "models.json"),
+        fetch: Callable[[], List[str]] = fetch_groq_models,
+        retry_after: float = 60
+    ) -> None:
+        self.ttl = ttl
+        self.path = path
+        self.fetch = fetch
+        self.retry_after = retry_after
+        self._models: Optional[List[str]] = None
+        self._fetched_at = 0.0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fallback() -> List[str]:
+        return list(get_args(valid_model_names))
+
+    def _load(self) -> None:
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self._models, self._fetched_at = list(data['models']), float(data['fetched_at'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Write to a temporary file first so concurrent readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".")
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'models': self._models, 'fetched_at': self._fetched_at}, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass  # Persistence is best effort
+
+    def models(self, refresh: bool = False) -> List[str]:
+        with self._lock:
+            if self._models is None and not self._checked_at:
+                self._load()
+            now = time.time()
+            stale = now - self._fetched_at > self.ttl
+            # Back off after a failure rather than hitting a failing API on every call
+            if refresh or (stale and now - self._checked_at > self.retry_after):
+                self._checked_at = now
+                try:
+                    models = self.fetch()
+                except Exception:
+                    models = None
+                if models:
+                    self._models, self._fetched_at = list(models), now
+                    self._save()
+            return list(self._models) if self._models else self.fallback()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models, self._fetched_at, self._checked_at = None, 0.0, 0.0
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+_default_catalog: Optional[ModelCatalog] = None
+
+
+def get_model_catalog() -> ModelCatalog:
+    """Process-wide catalog shared by every Streamlit session."""
+    global _default_catalog
+    if _default_catalog is None:
+        _default_catalog = ModelCatalog()
+    return _default_catalog
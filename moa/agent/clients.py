@@ -0,0 +1,109 @@
+"""
+Process-wide HTTP clients shared by every ChatGroq instance
+"""
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+from pydantic import BaseModel
+
+
+class HTTPClientConfig(BaseModel):
+    """Connection pool settings for the shared clients.
+
+    ``base_url`` overrides the Groq API endpoint, e.g. to point every agent at a
+    local stand-in server; when unset ChatGroq falls back to ``GROQ_API_BASE``.
+    ``http2`` requires the ``h2`` package (``pip install httpx[http2]``).
+    """
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    http2: bool = False
+    base_url: Optional[str] = None
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+
+_lock = threading.Lock()
+_config = HTTPClientConfig()
+_client: Optional[httpx.Client] = None
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def configure_http_clients(**kwargs: Any) -> HTTPClientConfig:
+    """Update the pool settings. Clients created before the call keep their old pool."""
+    global _config, _client, _async_client
+    with _lock:
+        _config = HTTPClientConfig.model_validate({**_config.model_dump(), **kwargs})
+        _client = None
+        _async_client = None
+        return _config
+
+
+def get_http_client() -> httpx.Client:
+    global _client
+    with _lock:
+        if _client is None or _client.is_closed:
+            _client = httpx.Client(limits=_config.limits(), http2=_config.http2)
+        return _client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Shared async client. Its pooled connections belong to the event loop that opened them,
+    so long-lived processes should drive all async agents from a single loop."""
+    global _async_client
+    with _lock:
+        if _async_client is None or _async_client.is_closed:
+            _async_client = httpx.AsyncClient(limits=_config.limits(), http2=_config.http2)
+        return _async_client
+
+
+def shared_client_kwargs() -> Dict[str, Any]:
+    """ChatGroq keyword arguments that route a model through the shared clients."""
+    kwargs: Dict[str, Any] = {
+        'http_client': get_http_client(),
+        'http_async_client': get_async_http_client()
+    }
+    if _config.base_url:
+        kwargs['base_url'] = _config.base_url
+    return kwargs
+
+
+def close_http_clients() -> None:
+    global _client, _async_client
+    with _lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _async_client = None
+
+
+async def aclose_http_clients() -> None:
+    global _async_client
+    client = _async_client
+    close_http_clients()
+    if client is not None:
+        await client.aclose()
+
+
+# Replaces ChatGroq for every agent when set, e.g. with a fake model for offline benchmarks
+_chat_model_factory: Optional[Callable[..., Any]] = None
+
+
+def set_chat_model_factory(factory: Optional[Callable[..., Any]]) -> None:
+    """Build agents' chat models with ``factory(model=..., **llm_kwargs)``; ``None`` restores ChatGroq."""
+    global _chat_model_factory
+    _chat_model_factory = factory
+
+
+def create_chat_model(model_name: str, **llm_kwargs: Any):
+    if _chat_model_factory is not None:
+        return _chat_model_factory(model=model_name, **llm_kwargs)
+
+    from langchain_groq import ChatGroq
+    return ChatGroq(model=model_name, **{**shared_client_kwargs(), **llm_kwargs})
@@ -0,0 +1,306 @@
+"""
+Single-flight coalescing of identical concurrent agent calls
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from .cache import cache_key
+from .instrumentation import get_trace, record_event
+
+
+class StreamFlight:
+    """One upstream stream replayed to every subscriber.
+
+    There is no pump thread: whichever subscriber first needs a chunk that
+    hasn't arrived yet pulls it from upstream while the others wait.
+    Subscribers joining late first get the chunks already produced.
+    """
+
+    def __init__(self, stream: Iterator[str]) -> None:
+        self.stream = stream
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self._pumping = False
+        self._cond = threading.Condition()
+
+    def _pump(self) -> None:
+        chunk, done, error = None, False, None
+        try:
+            chunk = next(self.stream)
+        except StopIteration:
+            done = True
+        except Exception as e:
+            done, error = True, e
+        with self._cond:
+            if chunk is not None:
+                self.chunks.append(chunk)
+            self.done, self.error = done, error
+            self._pumping = False
+            self._cond.notify_all()
+
+    def subscribe(self) -> Iterator[str]:
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self.chunks) and not self.done and self._pumping:
+                    self._cond.wait()
+                if i < len(self.chunks):
+                    chunk = self.chunks[i]
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    self._pumping = True
+                    chunk = None
+            if chunk is None:
+                self._pump()
+                continue
+            i += 1
+            yield chunk
+
+    def abandon(self) -> None:
+        self.stream.close()
+
+
+class AsyncStreamFlight:
+    """Async counterpart of ``StreamFlight``, pumped by a task of its own.
+
+    A subscriber being cancelled must not cancel the upstream call the others
+    are waiting on, so no subscriber pulls from it directly.
+    """
+
+    def __init__(self, stream: AsyncIterator[str]) -> None:
+        self.stream = stream
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump())
+
+    async def _pump(self) -> None:
+        try:
+            async for chunk in self.stream:
+                self.chunks.append(chunk)
+                self._changed.set()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._changed.set()
+            await self.stream.aclose()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        i = 0
+        while True:
+            if i < len(self.chunks):
+                i += 1
+                yield self.chunks[i - 1]
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                self._changed.clear()
+                await self._changed.wait()
+
+    def abandon(self) -> None:
+        self.task.cancel()
+
+
+class SingleFlight:
+    """Registry of in-flight calls, so identical concurrent requests share one upstream call.
+
+    A flight is forgotten as soon as it completes, so only callers that arrive
+    while it is running share it; completed results are the cache's business.
+    It is abandoned (its upstream request closed) once every caller has left.
+
+    Callers pass an ``owner`` (the turn they belong to) and never join a flight
+    one of their owner's calls is already on: agents of the same turn sampling
+    the same model are meant to get independent answers.
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[Tuple[str, str], List[List[Any]]] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key: Tuple[str, str], start: Callable[[], Any], owner: Optional[int] = None) -> Tuple[List[Any], bool]:
+        """``[flight, subscribers, owners]`` for ``key``, starting a flight if none can be joined."""
+        with self._lock:
+            entries = self._flights.setdefault(key, [])
+            entry = next((e for e in entries if owner is None or owner not in e[2]), None)
+            joined = entry is not None
+            if not joined:
+                entry = [start(), 0, set()]
+                entries.append(entry)
+            entry[1] += 1
+            if owner is not None:
+                entry[2].add(owner)
+            return entry, joined
+
+    def _leave(self, key: Tuple[str, str], entry: List[Any]) -> bool:
+        """Drop a subscriber and return whether it was the last one."""
+        with self._lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._forget(key, entry)
+            return entry[1] == 0
+
+    def _forget(self, key: Tuple[str, str], entry: List[Any]) -> None:
+        entries = self._flights.get(key, [])
+        for i, other in enumerate(entries):
+            if other is entry:
+                del entries[i]
+                break
+        if not entries:
+            self._flights.pop(key, None)
+
+    @staticmethod
+    def _loop_key(kind: str, key: str) -> Tuple[str, str]:
+        # Tasks and events belong to one event loop
+        return (f"{kind}:{id(asyncio.get_running_loop())}", key)
+
+    def invoke(self, key: str, call: Callable[[], str], owner: Optional[int] = None) -> Tuple[str, bool]:
+        """``call()``'s result, or that of an identical call already running, and whether it was shared."""
+        entry, joined = self._join(('invoke', key), Future, owner)
+        future: Future = entry[0]
+        try:
+            if not joined:
+                try:
+                    future.set_result(call())
+                except Exception as e:
+                    future.set_exception(e)
+                finally:
+                    with self._lock:
+                        self._forget(('invoke', key), entry)
+            return future.result(), joined
+        finally:
+            self._leave(('invoke', key), entry)
+
+    async def ainvoke(self, key: str, call: Callable[[], Any], owner: Optional[int] = None) -> Tuple[str, bool]:
+        loop_key = self._loop_key('invoke', key)
+        entry, joined = self._join(loop_key, lambda: asyncio.ensure_future(call()), owner)
+        task: asyncio.Future = entry[0]
+        if not joined:
+            task.add_done_callback(lambda _: self._forget_locked(loop_key, entry))
+        try:
+            return await asyncio.shield(task), joined
+        finally:
+            if self._leave(loop_key, entry) and not task.done():
+                task.cancel()
+
+    def stream(self, key: str, stream: Callable[[], Iterator[str]], owner: Optional[int] = None) -> Tuple[Iterator[str], bool]:
+        entry, joined = self._join(('stream', key), lambda: StreamFlight(stream()), owner)
+        return self._subscribe(('stream', key), entry), joined
+
+    def _subscribe(self, key: Tuple[str, str], entry: List[Any]) -> Iterator[str]:
+        flight: StreamFlight = entry[0]
+        try:
+            yield from flight.subscribe()
+        finally:
+            with self._lock:
+                if flight.done:
+                    self._forget(key, entry)
+            if self._leave(key, entry) and not flight.done:
+                flight.abandon()
+
+    def astream(self, key: str, stream: Callable[[], AsyncIterator[str]], owner: Optional[int] = None) -> Tuple[AsyncIterator[str], bool]:
+        loop_key = self._loop_key('stream', key)
+        entry, joined = self._join(loop_key, lambda: AsyncStreamFlight(stream()), owner)
+        if not joined:
+            entry[0].task.add_done_callback(lambda _: self._forget_locked(loop_key, entry))
+        return self._asubscribe(loop_key, entry), joined
+
+    async def _asubscribe(self, key: Tuple[str, str], entry: List[Any]) -> AsyncIterator[str]:
+        flight: AsyncStreamFlight = entry[0]
+        try:
+            async for chunk in flight.subscribe():
+                yield chunk
+        finally:
+            if self._leave(key, entry) and not flight.done:
+                flight.abandon()
+
+    def _forget_locked(self, key: Tuple[str, str], entry: List[Any]) -> None:
+        with self._lock:
+            self._forget(key, entry)
+
+
+_default_flights: Optional[SingleFlight] = None
+
+
+def get_default_flights() -> SingleFlight:
+    """Process-wide registry shared by every agent, so identical calls coalesce across conversations."""
+    global _default_flights
+    if _default_flights is None:
+        _default_flights = SingleFlight()
+    return _default_flights
+
+
+class CoalescedRunnable(Runnable[PromptValue, str]):
+    """Wraps an ``llm | StrOutputParser()`` runnable so identical concurrent calls share one request.
+
+    Calls are identical when ``params`` (model and sampling arguments) and the
+    rendered prompt match, as for ``CachedRunnable``. Streams are multicast: every
+    caller receives every chunk as it arrives. Calls of the same turn (trace)
+    are never merged, but concurrent conversations sampling a model with
+    ``temperature > 0`` do get the same sample.
+    """
+
+    def __init__(self, bound: Runnable[PromptValue, str], params: Dict[str, Any], flights: Optional[SingleFlight] = None) -> None:
+        self.bound = bound
+        self.params = params
+        self.flights = flights or get_default_flights()
+
+    @staticmethod
+    def _owner(config: Optional[RunnableConfig]) -> Optional[int]:
+        trace = get_trace(config)
+        return id(trace) if trace is not None else None
+
+    def _joined(self, config: Optional[RunnableConfig], joined: bool) -> None:
+        if joined:
+            record_event(config, 'coalesced', model=self.params.get('model'))
+
+    def invoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        output, joined = self.flights.invoke(
+            cache_key(self.params, input), lambda: self.bound.invoke(input, config, **kwargs),
+            self._owner(config)
+        )
+        self._joined(config, joined)
+        return output
+
+    async def ainvoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        output, joined = await self.flights.ainvoke(
+            cache_key(self.params, input), lambda: self.bound.ainvoke(input, config, **kwargs),
+            self._owner(config)
+        )
+        self._joined(config, joined)
+        return output
+
+    def stream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[str]:
+        chunks, joined = self.flights.stream(
+            cache_key(self.params, input), lambda: iter(self.bound.stream(input, config, **kwargs)),
+            self._owner(config)
+        )
+        self._joined(config, joined)
+        try:
+            yield from chunks
+        finally:
+            chunks.close()
+
+    async def astream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[str]:
+        chunks, joined = self.flights.astream(
+            cache_key(self.params, input), lambda: self.bound.astream(input, config, **kwargs),
+            self._owner(config)
+        )
+        self._joined(config, joined)
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
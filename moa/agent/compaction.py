@@ -0,0 +1,285 @@
+"""
+Compaction of layer responses before they are passed on to the next agents
+"""
+import asyncio
+import re
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
+
+from pydantic import BaseModel
+from langchain_core.runnables import Runnable
+
+from .convergence import WORD_PATTERN, cosine_similarity, term_counts
+from .memory import DEFAULT_COMPLETION_RESERVE, context_window, count_tokens
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n+")
+TRUNCATION_MARKER = " [...]"
+
+
+class CompactionPolicy(BaseModel):
+    """How layer responses are shortened before reaching the next agents.
+
+    Responses at least ``dedupe_threshold`` similar to an earlier one are
+    dropped, and each is capped at ``max_response_tokens``. When the responses
+    still don't fit the consuming model's context (or ``max_tokens``) they are
+    reduced to a fair share of the budget, by truncation, by keeping their most
+    representative sentences (``'extractive'``) or by asking ``model`` to
+    condense them (``'llm'``).
+    """
+    dedupe_threshold: Optional[float] = None
+    max_response_tokens: Optional[int] = None
+    max_tokens: Optional[int] = None
+    method: Literal['truncate', 'extractive', 'llm'] = 'extractive'
+    model: Optional[str] = None
+
+    @classmethod
+    def from_config(cls, spec: Optional[Union["CompactionPolicy", Dict[str, Any]]]) -> "CompactionPolicy":
+        if spec is None:
+            return cls()
+        if isinstance(spec, cls):
+            return spec
+        return cls.model_validate(spec)
+
+
+def format_responses(reference_system_prompt: str, responses: List[str]) -> str:
+    numbered = "".join(f"{i}. {out}\n" for i, out in enumerate(responses))
+    return reference_system_prompt.format(responses=numbered)
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """Cut ``text`` to about ``max_tokens`` tokens at a word boundary."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    limit = max(0, max_tokens * 4 - len(TRUNCATION_MARKER))
+    cut = text[:limit]
+    if " " in cut:
+        cut = cut[:cut.rindex(" ")]
+    return cut + TRUNCATION_MARKER
+
+
+def extract(text: str, max_tokens: int, weights: Counter) -> str:
+    """Keep the sentences richest in ``weights`` terms, in their original order."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    sentences = [s for s in SENTENCE_PATTERN.split(text) if s.strip()]
+
+    def score(sentence: str) -> float:
+        terms = set(WORD_PATTERN.findall(sentence.lower()))
+        return sum(weights[t] for t in terms) / (len(terms) or 1)
+
+    kept, budget = set(), max_tokens
+    for i in sorted(range(len(sentences)), key=lambda i: score(sentences[i]), reverse=True):
+        cost = count_tokens(sentences[i]) + 1
+        if cost <= budget:
+            kept.add(i)
+            budget -= cost
+    if not kept:
+        return truncate(text, max_tokens)
+    return " ".join(sentences[i] for i in sorted(kept))
+
+
+def allocate(lengths: List[int], budget: int) -> List[int]:
+    """Split ``budget`` fairly: short items keep their length, long ones share the rest."""
+    shares = [0] * len(lengths)
+    remaining = budget
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    for n, i in enumerate(order):
+        shares[i] = min(lengths[i], remaining // (len(lengths) - n))
+        remaining -= shares[i]
+    return shares
+
+
+class ResponseCompactor:
+    """Applies a ``CompactionPolicy`` to a list of layer responses.
+
+    ``summarizer`` is the runnable (taking ``response`` and ``max_tokens``)
+    used by the ``'llm'`` method; without one it falls back to extraction.
+    Every agent consuming a layer compacts the same responses, so results are
+    memoized per responses and budget: agents sharing a budget, even running
+    concurrently, compact them once. The last ``maxsize`` results are kept.
+    """
+
+    def __init__(
+        self,
+        policy: Optional[CompactionPolicy] = None,
+        summarizer: Optional[Runnable[Dict[str, Any], str]] = None,
+        maxsize: int = 64
+    ) -> None:
+        self.policy = policy or CompactionPolicy()
+        self.summarizer = summarizer
+        self.maxsize = maxsize
+        self._results: "OrderedDict[Tuple[Tuple[str, ...], Optional[int]], Future]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def dedupe(self, responses: List[str]) -> List[str]:
+        if self.policy.dedupe_threshold is None:
+            return responses
+        kept, vectors = [], []
+        for response in responses:
+            vector = term_counts(response)
+            if all(cosine_similarity(vector, other) < self.policy.dedupe_threshold for other in vectors):
+                kept.append(response)
+                vectors.append(vector)
+        return kept
+
+    def reduce(self, text: str, max_tokens: int, weights: Counter) -> str:
+        if count_tokens(text) <= max_tokens:
+            return text
+        if self.policy.method == 'llm' and self.summarizer is not None:
+            text = self.summarizer.invoke({'response': text, 'max_tokens': max_tokens})
+            return truncate(text, max_tokens)
+        if self.policy.method == 'truncate':
+            return truncate(text, max_tokens)
+        return extract(text, max_tokens, weights)
+
+    def _summarized(self, responses: List[str], limits: List[int]) -> Tuple[List[int], List[Dict[str, Any]]]:
+        """Indices of the responses the summarizer must condense, and its inputs."""
+        if self.policy.method != 'llm' or self.summarizer is None:
+            return [], []
+        over = [i for i, (r, limit) in enumerate(zip(responses, limits)) if count_tokens(r) > limit]
+        return over, [{'response': responses[i], 'max_tokens': limits[i]} for i in over]
+
+    def reduce_all(self, responses: List[str], limits: List[int], weights: Counter) -> List[str]:
+        """``reduce`` each response to its limit, condensing with the summarizer in one concurrent batch."""
+        over, inputs = self._summarized(responses, limits)
+        if not over:
+            return [self.reduce(r, limit, weights) for r, limit in zip(responses, limits)]
+        reduced = list(responses)
+        for i, summary in zip(over, self.summarizer.batch(inputs)):
+            reduced[i] = truncate(summary, limits[i])
+        return reduced
+
+    async def areduce_all(self, responses: List[str], limits: List[int], weights: Counter) -> List[str]:
+        over, inputs = self._summarized(responses, limits)
+        if not over:
+            return [self.reduce(r, limit, weights) for r, limit in zip(responses, limits)]
+        reduced = list(responses)
+        for i, summary in zip(over, await self.summarizer.abatch(inputs)):
+            reduced[i] = truncate(summary, limits[i])
+        return reduced
+
+    def _prepare(self, responses: List[str]) -> Tuple[List[str], Counter]:
+        responses = self.dedupe(list(responses))
+        # Terms shared across responses mark the content worth keeping
+        weights = sum((Counter(set(term_counts(r))) for r in responses), Counter())
+        return responses, weights
+
+    def _shares(self, responses: List[str], max_tokens: Optional[int]) -> Optional[List[int]]:
+        """Per-response budgets when the responses don't fit ``max_tokens`` in total, else ``None``."""
+        budgets = [b for b in (max_tokens, self.policy.max_tokens) if b is not None]
+        lengths = [count_tokens(r) for r in responses]
+        if not budgets or sum(lengths) <= min(budgets):
+            return None
+        return allocate(lengths, max(min(budgets), 0))
+
+    def _claim(self, key: Tuple[Tuple[str, ...], Optional[int]]) -> Tuple[Future, bool]:
+        """The memoized result for ``key``, and whether the caller must compute it."""
+        with self._lock:
+            future = self._results.get(key)
+            if future is not None:
+                self._results.move_to_end(key)
+                return future, False
+            future = self._results[key] = Future()
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+            return future, True
+
+    def _abandon(self, key: Tuple[Tuple[str, ...], Optional[int]], future: Future) -> None:
+        # Don't memoize a failure; callers waiting on it compute the result themselves
+        with self._lock:
+            if self._results.get(key) is future:
+                del self._results[key]
+        future.set_result(None)
+
+    def compact(self, responses: List[str], max_tokens: Optional[int] = None) -> List[str]:
+        """Deduplicate and shorten ``responses`` to fit ``max_tokens`` in total."""
+        key = (tuple(responses), max_tokens)
+        future, owner = self._claim(key)
+        if not owner:
+            result = future.result()
+            if result is not None:
+                return list(result)
+        try:
+            responses, weights = self._prepare(responses)
+            if self.policy.max_response_tokens is not None:
+                responses = self.reduce_all(responses, [self.policy.max_response_tokens] * len(responses), weights)
+            shares = self._shares(responses, max_tokens)
+            if shares is not None:
+                responses = self.reduce_all(responses, shares, weights)
+        except BaseException:
+            if owner:
+                self._abandon(key, future)
+            raise
+        if owner:
+            future.set_result(responses)
+        return list(responses)
+
+    async def acompact(self, responses: List[str], max_tokens: Optional[int] = None) -> List[str]:
+        key = (tuple(responses), max_tokens)
+        future, owner = self._claim(key)
+        if not owner:
+            result = await asyncio.wrap_future(future)
+            if result is not None:
+                return list(result)
+        try:
+            responses, weights = self._prepare(responses)
+            if self.policy.max_response_tokens is not None:
+                responses = await self.areduce_all(responses, [self.policy.max_response_tokens] * len(responses), weights)
+            shares = self._shares(responses, max_tokens)
+            if shares is not None:
+                responses = await self.areduce_all(responses, shares, weights)
+        except BaseException:
+            if owner:
+                self._abandon(key, future)
+            raise
+        if owner:
+            future.set_result(responses)
+        return list(responses)
+
+
+class CompactionWindow:
+    """Re-renders ``helper_response`` so the layer responses fit one agent's context."""
+
+    def __init__(
+        self,
+        compactor: ResponseCompactor,
+        model_name: Optional[str],
+        system_prompt: str,
+        reference_system_prompt: str,
+        completion_tokens: Optional[int] = None
+    ) -> None:
+        self.compactor = compactor
+        self.reference_system_prompt = reference_system_prompt
+        self.budget = (
+            context_window(model_name)
+            - (completion_tokens or DEFAULT_COMPLETION_RESERVE)
+            - count_tokens(system_prompt)
+            - count_tokens(format_responses(reference_system_prompt, []))
+        )
+
+    def _budget(self, inputs: Dict[str, Any]) -> Optional[int]:
+        """Token budget for the responses, or ``None`` if they already fit."""
+        responses = inputs.get('responses')
+        if not responses:
+            return None
+        available = self.budget - count_tokens(str(inputs.get('input', "")))
+        if count_tokens(str(inputs.get('helper_response', ""))) <= available:
+            return None
+        # Numbering and line breaks cost a couple of tokens per response
+        return max(available - 2 * len(responses), 0)
+
+    def apply(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        budget = self._budget(inputs)
+        if budget is None:
+            return inputs
+        compacted = self.compactor.compact(inputs['responses'], budget)
+        return {**inputs, 'helper_response': format_responses(self.reference_system_prompt, compacted)}
+
+    async def aapply(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        budget = self._budget(inputs)
+        if budget is None:
+            return inputs
+        compacted = await self.compactor.acompact(inputs['responses'], budget)
+        return {**inputs, 'helper_response': format_responses(self.reference_system_prompt, compacted)}
@@ -0,0 +1,64 @@
+"""
+Lexical agreement between layer responses, used to stop cycling early
+"""
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+from itertools import combinations
+from typing import Any, Dict, List, Optional, Union
+
+from pydantic import BaseModel
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=256)
+def term_counts(text: str) -> Counter:
+    """Bag of words of ``text``. Cached, since agreement and compaction both need each
+    layer response's; callers must not modify the returned counter."""
+    return Counter(WORD_PATTERN.findall(text.lower()))
+
+
+def cosine_similarity(a: Counter, b: Counter) -> float:
+    """Cosine of two bag-of-words vectors, 0 for an empty one."""
+    dot = sum(count * b[term] for term, count in a.items())
+    norm = math.sqrt(sum(c * c for c in a.values())) * math.sqrt(sum(c * c for c in b.values()))
+    return dot / norm if norm else 0.0
+
+
+def agreement(responses: List[str]) -> Optional[float]:
+    """Mean pairwise cosine similarity of ``responses``, ``None`` with fewer than two."""
+    vectors = [term_counts(r) for r in responses]
+    pairs = list(combinations(vectors, 2))
+    if not pairs:
+        return None
+    return sum(cosine_similarity(a, b) for a, b in pairs) / len(pairs)
+
+
+class ConvergencePolicy(BaseModel):
+    """Stop running layer cycles once the layer agents agree.
+
+    After each cycle the pairwise lexical similarity of the layer responses is
+    averaged; once it reaches ``threshold`` (and at least ``min_cycles`` have
+    run) the remaining cycles are skipped and the main agent answers. Without a
+    threshold every configured cycle runs.
+    """
+    threshold: Optional[float] = None
+    min_cycles: int = 1
+
+    @classmethod
+    def from_config(cls, spec: Optional[Union["ConvergencePolicy", Dict[str, Any], float]]) -> "ConvergencePolicy":
+        if spec is None:
+            return cls()
+        if isinstance(spec, cls):
+            return spec
+        if isinstance(spec, (int, float)):
+            return cls(threshold=spec)
+        return cls.model_validate(spec)
+
+    def converged(self, cycle: int, score: Optional[float]) -> bool:
+        """Whether the layer has converged after ``cycle`` (1-based) scored ``score``."""
+        if self.threshold is None or score is None:
+            return False
+        return cycle >= self.min_cycles and score >= self.threshold
@@ -0,0 +1,483 @@
+"""
+Model failover, circuit breaking and hedged requests
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import aclosing, closing
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+from pydantic import BaseModel
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from .instrumentation import percentile, record_event
+from .scheduler import RateLimitExceeded
+
+Candidate = Tuple[str, Runnable[PromptValue, str]]
+
+
+class CircuitBreakerPolicy(BaseModel):
+    """When a model is taken out of rotation.
+
+    A model's circuit opens once at least ``min_calls`` of its last ``window``
+    calls were recorded and ``failure_rate`` of them failed. Calls slower than
+    ``slow_call_duration`` seconds count as failures. After ``cooldown`` seconds
+    a single probe call is let through; its outcome closes or reopens the circuit.
+    """
+    window: int = 20
+    min_calls: int = 5
+    failure_rate: float = 0.5
+    slow_call_duration: Optional[float] = None
+    cooldown: float = 30.0
+
+    @classmethod
+    def from_config(cls, spec: Optional[Union["CircuitBreakerPolicy", Dict[str, Any]]]) -> "CircuitBreakerPolicy":
+        if spec is None:
+            return cls()
+        if isinstance(spec, cls):
+            return spec
+        return cls.model_validate(spec)
+
+
+class ModelState:
+    def __init__(self, window: int, samples: int) -> None:
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.latencies: Deque[float] = deque(maxlen=samples)
+        self.ttfts: Deque[float] = deque(maxlen=samples)
+        self.opened_at: Optional[float] = None
+        self.probe_started: Optional[float] = None
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+
+    @property
+    def failure_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+
+class ModelHealth:
+    """Error rates, latencies and circuit state of every model, shared by all agents in the process.
+
+    ``samples`` successful latencies and times to first token are kept per model
+    to derive hedging delays.
+    """
+
+    def __init__(self, policy: Optional[CircuitBreakerPolicy] = None, samples: int = 200) -> None:
+        self.policy = policy or CircuitBreakerPolicy()
+        self.samples = samples
+        self._models: Dict[str, ModelState] = {}
+        self._lock = threading.Lock()
+
+    def _state(self, model: str) -> ModelState:
+        state = self._models.get(model)
+        if state is None:
+            state = self._models[model] = ModelState(self.policy.window, self.samples)
+        return state
+
+    def allow(self, model: str) -> bool:
+        """Whether ``model`` may be called now. Claims the probe of an open circuit past its cooldown."""
+        with self._lock:
+            state = self._state(model)
+            if state.opened_at is None:
+                return True
+            now = time.monotonic()
+            # A probe that never reported back (e.g. lost with its thread) is given up after a cooldown
+            probing = state.probe_started is not None and now - state.probe_started < self.policy.cooldown
+            if now - state.opened_at >= self.policy.cooldown and not probing:
+                state.probe_started = now
+                return True
+            state.rejected += 1
+            return False
+
+    def record(
+        self,
+        model: str,
+        error: Optional[Exception] = None,
+        duration: Optional[float] = None,
+        ttft: Optional[float] = None
+    ) -> None:
+        failure = error is not None or (
+            self.policy.slow_call_duration is not None
+            and duration is not None
+            and duration > self.policy.slow_call_duration
+        )
+        with self._lock:
+            state = self._state(model)
+            state.calls += 1
+            state.failures += failure
+            if error is None:
+                if duration is not None:
+                    state.latencies.append(duration)
+                if ttft is not None:
+                    state.ttfts.append(ttft)
+            if state.opened_at is not None:
+                if state.probe_started is None:
+                    return  # A call let through before the circuit opened
+                state.probe_started = None
+                state.opened_at = time.monotonic() if failure else None
+                state.outcomes.clear()
+                return
+            state.outcomes.append(failure)
+            if len(state.outcomes) >= self.policy.min_calls and state.failure_rate >= self.policy.failure_rate:
+                state.opened_at = time.monotonic()
+                state.outcomes.clear()
+
+    def release(self, model: str) -> None:
+        """Forget a call that ended without an outcome, such as one its caller abandoned."""
+        with self._lock:
+            self._state(model).probe_started = None
+
+    def is_open(self, model: str) -> bool:
+        with self._lock:
+            return self._state(model).opened_at is not None
+
+    def latency(self, model: str, q: float, first_token: bool = False, min_samples: int = 0) -> Optional[float]:
+        """``q``-th percentile of successful call durations, or of times to first token."""
+        with self._lock:
+            state = self._state(model)
+            samples = list(state.ttfts if first_token else state.latencies)
+        return percentile(samples, q) if len(samples) >= max(min_samples, 1) else None
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Circuit state, failure rate and latency percentiles per model."""
+        with self._lock:
+            models = {model: state for model, state in self._models.items()}
+            return {
+                model: {
+                    'state': 'closed' if state.opened_at is None else 'open',
+                    'calls': state.calls,
+                    'failures': state.failures,
+                    'rejected': state.rejected,
+                    'failure_rate': state.failure_rate,
+                    'latency_p95': percentile(list(state.latencies), 95),
+                    'ttft_p95': percentile(list(state.ttfts), 95),
+                }
+                for model, state in models.items()
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+
+
+_default_health: Optional[ModelHealth] = None
+
+
+def get_default_health() -> ModelHealth:
+    """Process-wide model health used by agents unless another one is passed to ``MOAgent.from_config``."""
+    global _default_health
+    if _default_health is None:
+        _default_health = ModelHealth()
+    return _default_health
+
+
+class HedgePolicy(BaseModel):
+    """When to fire a backup request while the first one is still running.
+
+    The backup goes out once the call has run longer than the model's observed
+    ``percentile`` latency (time to first token for streams), measured over at
+    least ``min_samples`` calls, or after a fixed ``after`` seconds when set.
+    """
+    percentile: float = 95
+    min_samples: int = 20
+    after: Optional[float] = None
+
+    @classmethod
+    def from_config(cls, spec: Optional[Union["HedgePolicy", Dict[str, Any], bool, float]]) -> Optional["HedgePolicy"]:
+        if spec is None or spec is False:
+            return None
+        if spec is True:
+            return cls()
+        if isinstance(spec, cls):
+            return spec
+        if isinstance(spec, (int, float)):
+            return cls(after=spec)
+        return cls.model_validate(spec)
+
+    def delay(self, health: ModelHealth, model: str, first_token: bool) -> Optional[float]:
+        if self.after is not None:
+            return self.after
+        return health.latency(model, self.percentile, first_token=first_token, min_samples=self.min_samples)
+
+
+def _first_chunk(stream: Iterator[str]) -> Tuple[Iterator[str], Optional[str], float]:
+    try:
+        chunk = next(stream)
+    except StopIteration:
+        chunk = None
+    return stream, chunk, time.monotonic()
+
+
+class FailoverRunnable(Runnable[PromptValue, str]):
+    """Calls the first healthy model among ``candidates``, failing over to the next on error.
+
+    ``candidates`` are ``(model_name, runnable)`` pairs, the primary model first.
+    Models whose circuit is open are skipped; if every circuit is open the primary
+    is tried anyway. Streams only fail over before their first chunk. With a
+    ``hedge`` policy a backup call to the next candidate (or the same model if it
+    has no fallbacks) races the first one once it runs past the hedging delay,
+    and whichever answers first is used.
+    """
+
+    def __init__(
+        self,
+        candidates: List[Candidate],
+        health: Optional[ModelHealth] = None,
+        hedge: Optional[HedgePolicy] = None
+    ) -> None:
+        self.candidates = candidates
+        self.health = health or get_default_health()
+        self.hedge = hedge
+
+    def _plan(self, config: Optional[RunnableConfig]) -> Iterator[Candidate]:
+        """Candidates in order, skipping open circuits. Health is checked lazily, as each is needed."""
+        tried = False
+        for model, runnable in self.candidates:
+            if self.health.allow(model):
+                tried = True
+                yield model, runnable
+            else:
+                record_event(config, 'circuit_open', model=model)
+        if not tried:
+            yield self.candidates[0]
+
+    def _delay(self, first_token: bool) -> Optional[float]:
+        if self.hedge is None:
+            return None
+        return self.hedge.delay(self.health, self.candidates[0][0], first_token)
+
+    def _failed(self, model: str, error: Exception, duration: float, config: Optional[RunnableConfig]) -> None:
+        if isinstance(error, RateLimitExceeded):
+            # Shed locally by the scheduler, which says nothing about the model's health
+            self.health.release(model)
+        else:
+            self.health.record(model, error=error, duration=duration)
+        record_event(config, 'failover', model=model, error=type(error).__name__)
+
+    def _hedged(self, model: str, delay: float, config: Optional[RunnableConfig]) -> None:
+        record_event(config, 'hedge', model=model, after=delay)
+
+    def _settle(self, model: str, start: float, outcome: Future, first_token: bool) -> None:
+        """Record the outcome of a call whose result was not used."""
+        if outcome.cancelled():
+            self.health.release(model)
+        elif outcome.exception() is not None:
+            self.health.record(model, error=outcome.exception(), duration=time.monotonic() - start)
+        elif first_token:
+            stream, _, first = outcome.result()
+            stream.close()
+            self.health.record(model, ttft=first - start)
+        else:
+            self.health.record(model, duration=time.monotonic() - start)
+
+    def _asettle(self, model: str, task: asyncio.Future, first_token: bool) -> None:
+        if first_token and not task.cancelled() and task.exception() is None:
+            # The losing stream produced its first chunk before it could be cancelled
+            asyncio.ensure_future(task.result()[0].aclose())
+        self.health.release(model)
+
+    def _next(self, plan: Iterator[Candidate], hedge: bool) -> Iterator[Candidate]:
+        """The next candidate to call; a hedge with no fallbacks goes to the same model."""
+        for candidate in plan:
+            yield candidate
+            return
+        if hedge and len(self.candidates) == 1:
+            yield self.candidates[0]
+
+    def _race(
+        self,
+        plan: Iterator[Candidate],
+        call: Callable[[Runnable[PromptValue, str]], Any],
+        delay: float,
+        config: Optional[RunnableConfig],
+        first_token: bool = False
+    ) -> Tuple[str, float, Any]:
+        """Run ``call`` in a thread, hedged after ``delay``; returns the winner's model, start time and result."""
+        executor = ThreadPoolExecutor(max_workers=2)
+        running: Dict[Future, Tuple[str, float]] = {}
+        error: Optional[Exception] = None
+
+        def launch(hedge: bool = False) -> Optional[str]:
+            for model, runnable in self._next(plan, hedge):
+                running[executor.submit(call, runnable)] = (model, time.monotonic())
+                return model
+            return None
+
+        try:
+            launch()
+            hedged = False
+            while running:
+                done, _ = wait(running, timeout=None if hedged else delay, return_when=FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    backup = launch(hedge=True)
+                    if backup is not None:
+                        self._hedged(backup, delay, config)
+                    continue
+                for future in done:
+                    model, start = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self._failed(model, e, time.monotonic() - start, config)
+                        error = e
+                        continue
+                    return model, start, result
+                if not running:
+                    launch()
+            raise error
+        finally:
+            for future, (model, start) in running.items():
+                future.add_done_callback(partial(self._settle, model, start, first_token=first_token))
+            executor.shutdown(wait=False)
+
+    def invoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        plan = self._plan(config)
+        delay = self._delay(first_token=False)
+        if delay is not None:
+            model, start, output = self._race(plan, lambda runnable: runnable.invoke(input, config, **kwargs), delay, config)
+            self.health.record(model, duration=time.monotonic() - start)
+            return output
+
+        error: Optional[Exception] = None
+        for model, runnable in plan:
+            start = time.monotonic()
+            try:
+                output = runnable.invoke(input, config, **kwargs)
+            except Exception as e:
+                self._failed(model, e, time.monotonic() - start, config)
+                error = e
+                continue
+            self.health.record(model, duration=time.monotonic() - start)
+            return output
+        raise error
+
+    def stream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[str]:
+        plan = self._plan(config)
+        delay = self._delay(first_token=True)
+        if delay is not None:
+            model, start, (stream, chunk, first) = self._race(
+                plan, lambda runnable: _first_chunk(iter(runnable.stream(input, config, **kwargs))), delay, config,
+                first_token=True
+            )
+            yield from self._finish(model, start, stream, chunk, first)
+            return
+
+        error: Optional[Exception] = None
+        for model, runnable in plan:
+            start = time.monotonic()
+            try:
+                stream, chunk, first = _first_chunk(iter(runnable.stream(input, config, **kwargs)))
+            except Exception as e:
+                self._failed(model, e, time.monotonic() - start, config)
+                error = e
+                continue
+            yield from self._finish(model, start, stream, chunk, first)
+            return
+        raise error
+
+    def _finish(self, model: str, start: float, stream: Iterator[str], chunk: Optional[str], first: float) -> Iterator[str]:
+        """Stream the rest of a call that produced its first chunk, recording its outcome."""
+        try:
+            with closing(stream):
+                if chunk is not None:
+                    yield chunk
+                yield from stream
+        except GeneratorExit:
+            # Cut short by the caller: how long the call would have taken is unknown
+            self.health.release(model)
+            raise
+        except Exception as e:
+            self.health.record(model, error=e, duration=time.monotonic() - start)
+            raise
+        self.health.record(model, duration=time.monotonic() - start, ttft=first - start)
+
+    async def _arace(
+        self,
+        plan: Iterator[Candidate],
+        call: Callable[[Runnable[PromptValue, str]], Any],
+        delay: Optional[float],
+        config: Optional[RunnableConfig],
+        first_token: bool = False
+    ) -> Tuple[str, float, Any]:
+        """Async counterpart of ``_race``; without a ``delay`` candidates are simply tried in turn."""
+        running: Dict[asyncio.Future, Tuple[str, float]] = {}
+        error: Optional[Exception] = None
+
+        def launch(hedge: bool = False) -> Optional[str]:
+            for model, runnable in self._next(plan, hedge):
+                running[asyncio.ensure_future(call(runnable))] = (model, time.monotonic())
+                return model
+            return None
+
+        try:
+            launch()
+            hedged = delay is None
+            while running:
+                done, _ = await asyncio.wait(running, timeout=None if hedged else delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    backup = launch(hedge=True)
+                    if backup is not None:
+                        self._hedged(backup, delay, config)
+                    continue
+                for task in done:
+                    model, start = running.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        self._failed(model, e, time.monotonic() - start, config)
+                        error = e
+                        continue
+                    return model, start, result
+                if not running:
+                    launch()
+            raise error
+        finally:
+            for task, (model, _) in running.items():
+                task.cancel()
+                task.add_done_callback(partial(self._asettle, model, first_token=first_token))
+            if running:
+                await asyncio.wait(running)
+
+    async def ainvoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        model, start, output = await self._arace(
+            self._plan(config), lambda runnable: runnable.ainvoke(input, config, **kwargs),
+            self._delay(first_token=False), config
+        )
+        self.health.record(model, duration=time.monotonic() - start)
+        return output
+
+    async def astream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[str]:
+        async def first_chunk(runnable: Runnable[PromptValue, str]) -> Tuple[AsyncIterator[str], Optional[str], float]:
+            stream = runnable.astream(input, config, **kwargs)
+            try:
+                chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+            except BaseException:
+                await stream.aclose()
+                raise
+            return stream, chunk, time.monotonic()
+
+        model, start, (stream, chunk, first) = await self._arace(
+            self._plan(config), first_chunk, self._delay(first_token=True), config, first_token=True
+        )
+        try:
+            async with aclosing(stream):
+                if chunk is not None:
+                    yield chunk
+                async for chunk in stream:
+                    yield chunk
+        except (GeneratorExit, asyncio.CancelledError):
+            self.health.release(model)
+            raise
+        except Exception as e:
+            self.health.record(model, error=e, duration=time.monotonic() - start)
+            raise
+        self.health.record(model, duration=time.monotonic() - start, ttft=first - start)
+
@@ -0,0 +1,126 @@
+"""
+Deterministic fake chat model for offline benchmarks
+"""
+import asyncio
+import hashlib
+import itertools
+import random
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from pydantic import BaseModel
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from .memory import count_message_tokens
+
+
+class FakeLLMError(Exception):
+    """Injected upstream failure; ``status_code`` makes it look like a 503 to the scheduler."""
+    status_code = 503
+
+
+class FakeModelProfile(BaseModel):
+    """Latency and output shape of one fake model.
+
+    Time to first token is drawn from a log-normal distribution with median
+    ``ttft`` and shape ``ttft_sigma``; the rest of the answer streams at
+    ``tokens_per_sec``.
+    """
+    ttft: float = 0.2
+    ttft_sigma: float = 0.3
+    tokens_per_sec: float = 500.0
+    output_tokens: int = 64
+    failure_rate: float = 0.0
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that answers with filler tokens after simulated latency.
+
+    Answers are a deterministic function of the prompt, so caches and
+    deduplication behave as they would against a real backend. Latencies and
+    failures follow a seeded sequence per model instance.
+    """
+    model_name: str = "fake"
+    profile: FakeModelProfile = FakeModelProfile()
+    seed: int = 0
+    calls: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "moa-fake"
+
+    def _plan(self, messages: List[BaseMessage]) -> Dict[str, Any]:
+        prompt = "\n".join(f"{m.type}:{m.content}" for m in messages)
+        digest = hashlib.sha256(f"{self.seed}:{self.model_name}:{prompt}".encode()).hexdigest()
+        # Latency and failures vary per call, the answer is fixed per prompt
+        if self.calls is None:
+            self.calls = itertools.count()
+        rng = random.Random(f"{self.seed}:{self.model_name}:{next(self.calls)}")
+        tokens = [f"{self.model_name}-{digest[i % 64]}{i} " for i in range(self.profile.output_tokens)]
+        return {
+            'ttft': rng.lognormvariate(0, self.profile.ttft_sigma) * self.profile.ttft,
+            'interval': 1.0 / self.profile.tokens_per_sec if self.profile.tokens_per_sec else 0.0,
+            'fail': rng.random() < self.profile.failure_rate,
+            'tokens': tokens,
+            'usage': {
+                'input_tokens': count_message_tokens(messages),
+                'output_tokens': len(tokens),
+                'total_tokens': count_message_tokens(messages) + len(tokens)
+            }
+        }
+
+    @staticmethod
+    def _chunk(plan: Dict[str, Any], i: int) -> ChatGenerationChunk:
+        # Like Groq, the last chunk reports the usage of the whole call
+        usage = plan['usage'] if i == len(plan['tokens']) - 1 else None
+        return ChatGenerationChunk(message=AIMessageChunk(content=plan['tokens'][i], usage_metadata=usage))
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        plan = self._plan(messages)
+        time.sleep(plan['ttft'])
+        if plan['fail']:
+            raise FakeLLMError(f"{self.model_name} is unavailable")
+        for i in range(len(plan['tokens'])):
+            if i:
+                time.sleep(plan['interval'])
+            yield self._chunk(plan, i)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        plan = self._plan(messages)
+        await asyncio.sleep(plan['ttft'])
+        if plan['fail']:
+            raise FakeLLMError(f"{self.model_name} is unavailable")
+        for i in range(len(plan['tokens'])):
+            if i:
+                await asyncio.sleep(plan['interval'])
+            yield self._chunk(plan, i)
+
+    @staticmethod
+    def _message(chunks: List[AIMessageChunk]) -> AIMessage:
+        usage = next((c.usage_metadata for c in chunks if c.usage_metadata), None)
+        return AIMessage(content="".join(c.content for c in chunks), usage_metadata=usage)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        chunks = [chunk.message for chunk in self._stream(messages, stop, **kwargs)]
+        return ChatResult(generations=[ChatGeneration(message=self._message(chunks))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        chunks = [chunk.message async for chunk in self._astream(messages, stop, **kwargs)]
+        return ChatResult(generations=[ChatGeneration(message=self._message(chunks))])
+
+
+def fake_chat_model_factory(
+    profiles: Optional[Dict[str, FakeModelProfile | Dict[str, Any]]] = None,
+    default: Optional[FakeModelProfile | Dict[str, Any]] = None,
+    seed: int = 0
+):
+    """Factory for ``set_chat_model_factory`` choosing a profile by model name."""
+    profiles = {name: FakeModelProfile.model_validate(p) for name, p in (profiles or {}).items()}
+    default = FakeModelProfile.model_validate(default or {})
+
+    def factory(model: str, **llm_kwargs: Any) -> FakeChatModel:
+        return FakeChatModel(model_name=model, profile=profiles.get(model, default), seed=seed)
+
+    return factory
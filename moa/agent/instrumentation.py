@@ -0,0 +1,337 @@
+"""
+Per-stage timing and token instrumentation for the MoA pipeline
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from contextlib import aclosing, closing, contextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import merge_configs
+
+from .memory import count_message_tokens, count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile, ``q`` in [0, 100]."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class Trace:
+    """Spans and events recorded while answering one chat turn.
+
+    A trace travels to the agent chains through ``RunnableConfig['configurable']``
+    (see ``trace_config``), so it works the same across threads and tasks.
+    """
+
+    def __init__(self, **attributes: Any) -> None:
+        self.attributes = attributes
+        self.start = time.time()
+        self.spans: List[Dict[str, Any]] = []
+        self.events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, start: float, end: float, **attributes: Any) -> Dict[str, Any]:
+        span = {'name': name, 'start': start, 'duration': end - start, **attributes}
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+        """Time a block; the yielded dict can be filled with extra attributes."""
+        start = time.time()
+        try:
+            yield attributes
+        finally:
+            self.add_span(name, start, time.time(), **attributes)
+
+    def event(self, name: str, **attributes: Any) -> None:
+        with self._lock:
+            self.events.append({'name': name, 'time': time.time(), **attributes})
+
+    def agent_spans(self, layer: int, agent: str) -> List[Dict[str, Any]]:
+        return [
+            s for s in self.spans
+            if s['name'] == 'llm' and s.get('layer') == layer and s.get('agent') == agent
+        ]
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            llm_spans = [s for s in self.spans if s['name'] == 'llm']
+            return {
+                **self.attributes,
+                'start': self.start,
+                'duration': time.time() - self.start,
+                'spans': list(self.spans),
+                'events': list(self.events),
+                'prompt_tokens': sum(s.get('prompt_tokens', 0) for s in llm_spans),
+                'completion_tokens': sum(s.get('completion_tokens', 0) for s in llm_spans),
+                'usage_estimated': any(s.get('estimated') for s in llm_spans),
+                'cache_hits': sum(1 for e in self.events if e['name'] == 'cache_hit'),
+                'retries': sum(1 for e in self.events if e['name'] == 'retry'),
+                'failovers': sum(1 for e in self.events if e['name'] == 'failover'),
+            }
+
+
+def trace_config(trace: Optional[Trace], **labels: Any) -> RunnableConfig:
+    """Runnable config carrying ``trace`` and the labels (agent, layer) of the call."""
+    if trace is None:
+        return {}
+    return {'configurable': {'moa_trace': trace, 'moa_labels': labels}}
+
+
+def get_trace(config: Optional[RunnableConfig]) -> Optional[Trace]:
+    return ((config or {}).get('configurable') or {}).get('moa_trace')
+
+
+def get_labels(config: Optional[RunnableConfig]) -> Dict[str, Any]:
+    return ((config or {}).get('configurable') or {}).get('moa_labels') or {}
+
+
+def record_event(config: Optional[RunnableConfig], name: str, **attributes: Any) -> None:
+    """Record an event (cache hit, retry, rate-limit wait) on the trace of the current call, if any."""
+    trace = get_trace(config)
+    if trace is not None:
+        trace.event(name, **get_labels(config), **attributes)
+
+
+def mark_call(config: Optional[RunnableConfig], **attributes: Any) -> None:
+    """Add attributes (such as ``cache_hit``) to the ``llm`` span of the current call, if it is instrumented."""
+    marks = ((config or {}).get('configurable') or {}).get('moa_call')
+    if marks is not None:
+        marks.update(attributes)
+
+
+class UsageHandler(BaseCallbackHandler):
+    """Collects the token usage the provider reported for the model calls of one agent call."""
+    run_inline = True
+
+    def __init__(self) -> None:
+        self.usage: List[Dict[str, int]] = []
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if usage:
+                    self.usage.append(usage)
+
+
+class InstrumentedRunnable(Runnable[PromptValue, str]):
+    """Records an ``llm`` span per call: duration, time to first token and token counts.
+
+    Token counts are the usage reported by the provider. Calls without one,
+    such as cache hits, coalesced or cancelled calls, get an estimate instead
+    and their span is marked ``estimated``.
+    """
+
+    def __init__(self, bound: Runnable[PromptValue, str], model_name: str) -> None:
+        self.bound = bound
+        self.model_name = model_name
+
+    @staticmethod
+    def _with_handler(config: Optional[RunnableConfig]) -> Tuple[Optional[RunnableConfig], Optional[UsageHandler]]:
+        if get_trace(config) is None:
+            return config, None
+        handler = UsageHandler()
+        return merge_configs(config, {'callbacks': [handler], 'configurable': {'moa_call': {}}}), handler
+
+    def _record(
+        self,
+        config,
+        input: PromptValue,
+        start: float,
+        output: str,
+        handler: Optional[UsageHandler],
+        first: Optional[float] = None,
+        cancelled: bool = False
+    ) -> None:
+        trace = get_trace(config)
+        if trace is None:
+            return
+        end = time.time()
+        if handler is not None and handler.usage:
+            prompt_tokens = sum(u.get('input_tokens', 0) for u in handler.usage)
+            completion_tokens = sum(u.get('output_tokens', 0) for u in handler.usage)
+            estimated = False
+        else:
+            prompt_tokens, completion_tokens = count_message_tokens(input.to_messages()), count_tokens(output)
+            estimated = True
+        attributes = {
+            **get_labels(config),
+            'model': self.model_name,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+        }
+        if estimated:
+            attributes['estimated'] = True
+        attributes.update(((config or {}).get('configurable') or {}).get('moa_call') or {})
+        if first is not None:
+            attributes['ttft'] = first - start
+            if end > first:
+                attributes['tokens_per_sec'] = completion_tokens / (end - first)
+        if cancelled:
+            attributes['cancelled'] = True
+        trace.add_span('llm', start, end, **attributes)
+
+    def invoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        start = time.time()
+        config, handler = self._with_handler(config)
+        output = self.bound.invoke(input, config, **kwargs)
+        self._record(config, input, start, output, handler)
+        return output
+
+    async def ainvoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        start = time.time()
+        config, handler = self._with_handler(config)
+        try:
+            output = await self.bound.ainvoke(input, config, **kwargs)
+        except asyncio.CancelledError:
+            self._record(config, input, start, "", handler, cancelled=True)
+            raise
+        self._record(config, input, start, output, handler)
+        return output
+
+    def stream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[str]:
+        start, first, output = time.time(), None, ""
+        config, handler = self._with_handler(config)
+        try:
+            with closing(self.bound.stream(input, config, **kwargs)) as stream:
+                for chunk in stream:
+                    first = first or time.time()
+                    output += chunk
+                    yield chunk
+        except GeneratorExit:
+            # The consumer stopped early; the tokens streamed so far were still spent
+            self._record(config, input, start, output, handler, first, cancelled=True)
+            raise
+        self._record(config, input, start, output, handler, first)
+
+    async def astream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[str]:
+        start, first, output = time.time(), None, ""
+        config, handler = self._with_handler(config)
+        try:
+            async with aclosing(self.bound.astream(input, config, **kwargs)) as stream:
+                async for chunk in stream:
+                    first = first or time.time()
+                    output += chunk
+                    yield chunk
+        except (GeneratorExit, asyncio.CancelledError):
+            self._record(config, input, start, output, handler, first, cancelled=True)
+            raise
+        self._record(config, input, start, output, handler, first)
+
+
+class MetricsSink(ABC):
+    """Receives the summary of every finished trace."""
+
+    @abstractmethod
+    def export(self, trace: Dict[str, Any]) -> None:
+        ...
+
+
+class HistogramSink(MetricsSink):
+    """In-process latency histograms per stage, keeping the last ``window`` samples of each."""
+
+    def __init__(self, window: int = 1000) -> None:
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.window))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(span: Dict[str, Any]) -> str:
+        if span['name'] == 'llm':
+            return f"llm:{span.get('agent', 'unknown')}:{span.get('model')}"
+        return span['name']
+
+    def export(self, trace: Dict[str, Any]) -> None:
+        with self._lock:
+            self._samples['total'].append(trace['duration'])
+            for span in trace['spans']:
+                self._samples[self._key(span)].append(span['duration'])
+                if 'ttft' in span:
+                    self._samples[f"{self._key(span)}:ttft"].append(span['ttft'])
+
+    def percentile(self, key: str, q: float) -> Optional[float]:
+        with self._lock:
+            samples = list(self._samples.get(key, ()))
+        return percentile(samples, q)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {
+            key: {
+                'count': len(self._samples[key]),
+                'p50': self.percentile(key, 50),
+                'p95': self.percentile(key, 95),
+                'p99': self.percentile(key, 99),
+            }
+            for key in list(self._samples)
+        }
+
+
+class JSONLogSink(MetricsSink):
+    """Writes one JSON line per trace to ``path``, or to the module logger when no path is given."""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace: Dict[str, Any]) -> None:
+        line = json.dumps(trace, default=str)
+        if self.path is None:
+            logger.info(line)
+            return
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line + "\n")
+
+
+class OpenTelemetrySink(MetricsSink):
+    """Replays each trace as OpenTelemetry spans. Requires ``opentelemetry-api``."""
+
+    def __init__(self, tracer_name: str = "moa") -> None:
+        try:
+            from opentelemetry import trace as otel_trace
+        except ImportError:
+            raise ImportError(
+                "Could not import opentelemetry. "
+                "Please install it with `pip install opentelemetry-api opentelemetry-sdk`."
+            )
+        self._otel = otel_trace
+        self.tracer = otel_trace.get_tracer(tracer_name)
+
+    @staticmethod
+    def _attributes(values: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            f"moa.{k}": v for k, v in values.items()
+            if isinstance(v, (str, int, float, bool)) and k not in ('name', 'start', 'duration')
+        }
+
+    def export(self, trace: Dict[str, Any]) -> None:
+        to_ns = lambda seconds: int(seconds * 1e9)
+        root = self.tracer.start_span(
+            "moa.chat", start_time=to_ns(trace['start']), attributes=self._attributes(trace)
+        )
+        context = self._otel.set_span_in_context(root)
+        for span in trace['spans']:
+            child = self.tracer.start_span(
+                f"moa.{span['name']}",
+                context=context,
+                start_time=to_ns(span['start']),
+                attributes=self._attributes(span)
+            )
+            child.end(end_time=to_ns(span['start'] + span['duration']))
+        root.end(end_time=to_ns(trace['start'] + trace['duration']))
@@ -0,0 +1,209 @@
+"""
+Bounded conversation memory and token-budgeted history windows
+"""
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional, Union
+
+from pydantic import BaseModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+from langchain_core.runnables import Runnable
+
+# Context window sizes in tokens, used to budget history for each target model
+MODEL_CONTEXT_WINDOWS = {
+    'llama3-70b-8192': 8192,
+    'llama3-8b-8192': 8192,
+    'gemma-7b-it': 8192,
+    'gemma2-9b-it': 8192,
+    'mixtral-8x7b-32768': 32768,
+    'llama-3.1-8b-instant': 131072,
+    'llama-3.1-70b-versatile': 131072,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+# Tokens kept free for the completion when an agent does not set max_tokens
+DEFAULT_COMPLETION_RESERVE = 1024
+# Approximate per-message overhead added by chat templates
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text: str) -> int:
+    """Cheap token estimate (about four characters per token) that needs no tokenizer."""
+    return (len(text) + 3) // 4
+
+
+def count_message_tokens(messages: List[BaseMessage]) -> int:
+    return sum(count_tokens(str(m.content)) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def context_window(model_name: Optional[str]) -> int:
+    return MODEL_CONTEXT_WINDOWS.get(model_name, DEFAULT_CONTEXT_WINDOW)
+
+
+def trim_history(
+    messages: List[BaseMessage],
+    max_tokens: Optional[int] = None,
+    max_messages: Optional[int] = None
+) -> List[BaseMessage]:
+    """Keep the most recent messages that fit the budget.
+
+    A leading ``SystemMessage`` (the rolling summary) is kept whenever it fits.
+    """
+    return HistoryIndex(messages).trim(max_tokens, max_messages)
+
+
+class HistoryIndex:
+    """Token costs of a conversation history, counted once per turn.
+
+    Every agent of every cycle trims the same history to its own budget; with
+    the cumulative costs of the most recent messages at hand, each window is a
+    binary search instead of another pass over the messages.
+    """
+
+    def __init__(self, messages: List[BaseMessage]) -> None:
+        self.messages = messages
+        self.summary = messages[:1] if messages and isinstance(messages[0], SystemMessage) else []
+        self.history = messages[len(self.summary):]
+        self.summary_tokens = count_message_tokens(self.summary)
+        # recent_tokens[k] is the cost of the last k messages
+        self.recent_tokens = [0]
+        for message in reversed(self.history):
+            self.recent_tokens.append(self.recent_tokens[-1] + count_message_tokens([message]))
+
+    def trim(self, max_tokens: Optional[int] = None, max_messages: Optional[int] = None) -> List[BaseMessage]:
+        limit = len(self.history) if max_messages is None else min(max(max_messages, 0), len(self.history))
+        if max_tokens is None:
+            return self.summary + self.history[len(self.history) - limit:]
+
+        summary, budget = self.summary, max_tokens - self.summary_tokens
+        if budget < 0:
+            summary, budget = [], max_tokens
+        kept = bisect_right(self.recent_tokens, budget, 0, limit + 1) - 1
+        return summary + self.history[len(self.history) - kept:]
+
+
+class HistoryPolicy(BaseModel):
+    """How much conversation history an agent sees.
+
+    ``max_tokens`` and ``max_messages`` cap the window; independently of them the
+    window never exceeds what fits the model's context next to the rendered prompt.
+    """
+    max_tokens: Optional[int] = None
+    max_messages: Optional[int] = None
+
+    @classmethod
+    def from_config(cls, spec: Optional[Union["HistoryPolicy", Dict[str, Any], int]]) -> "HistoryPolicy":
+        if spec is None:
+            return cls()
+        if isinstance(spec, cls):
+            return spec
+        if isinstance(spec, int):
+            return cls(max_tokens=spec)
+        return cls.model_validate(spec)
+
+
+class HistoryWindow:
+    """Trims ``messages`` in an agent's input to its policy and context budget."""
+
+    def __init__(
+        self,
+        model_name: Optional[str],
+        system_prompt: str,
+        policy: Optional[HistoryPolicy] = None,
+        completion_tokens: Optional[int] = None
+    ) -> None:
+        self.policy = policy or HistoryPolicy()
+        self.budget = (
+            context_window(model_name)
+            - (completion_tokens or DEFAULT_COMPLETION_RESERVE)
+            - count_tokens(system_prompt)
+        )
+
+    def apply(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        messages = inputs.get('messages')
+        if not messages:
+            return inputs
+        budget = (
+            self.budget
+            - count_tokens(str(inputs.get('helper_response', "")))
+            - count_tokens(str(inputs.get('input', "")))
+        )
+        if self.policy.max_tokens is not None:
+            budget = min(budget, self.policy.max_tokens)
+        # MOAgent indexes the history once per turn and passes it along with the messages
+        index = inputs.get('history_index')
+        if index is None or index.messages is not messages:
+            index = HistoryIndex(messages)
+        return {
+            **inputs,
+            'messages': index.trim(max(budget, 0), self.policy.max_messages)
+        }
+
+    async def aapply(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        # Trimming an indexed history is cheap, so it runs on the event loop rather than in a thread
+        return self.apply(inputs)
+
+
+class BoundedConversationMemory:
+    """Conversation memory capped at ``max_token_limit`` tokens.
+
+    Drop-in for ``ConversationBufferMemory`` as used by ``MOAgent``. Messages pushed
+    out of the window are discarded, or folded into a rolling summary when a
+    ``summarizer`` runnable (taking ``summary`` and ``new_lines``) is given.
+    """
+
+    def __init__(
+        self,
+        max_token_limit: int = DEFAULT_CONTEXT_WINDOW,
+        summarizer: Optional[Runnable[Dict[str, str], str]] = None,
+        memory_key: str = "messages"
+    ) -> None:
+        self.max_token_limit = max_token_limit
+        self.summarizer = summarizer
+        self.memory_key = memory_key
+        self.messages: List[BaseMessage] = []
+        self.summary = ""
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def _history(self) -> List[BaseMessage]:
+        if self.summary:
+            return [SystemMessage(content=self.summary)] + self.messages
+        return list(self.messages)
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, List[BaseMessage]]:
+        return {self.memory_key: self._history()}
+
+    async def aload_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, List[BaseMessage]]:
+        return self.load_memory_variables(inputs)
+
+    def _append(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> List[BaseMessage]:
+        """Add a turn and return the messages that no longer fit the window."""
+        self.messages.append(HumanMessage(content=inputs['input']))
+        self.messages.append(AIMessage(content=outputs['output']))
+        evicted = []
+        while self.messages and count_message_tokens(self._history()) > self.max_token_limit:
+            # Evict whole turns so the window never starts with an AI message
+            evicted.extend(self.messages[:2])
+            del self.messages[:2]
+        return evicted
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        evicted = self._append(inputs, outputs)
+        if evicted and self.summarizer is not None:
+            self.summary = self.summarizer.invoke({
+                'summary': self.summary,
+                'new_lines': get_buffer_string(evicted)
+            })
+
+    async def asave_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        evicted = self._append(inputs, outputs)
+        if evicted and self.summarizer is not None:
+            self.summary = await self.summarizer.ainvoke({
+                'summary': self.summary,
+                'new_lines': get_buffer_string(evicted)
+            })
+
+    def clear(self) -> None:
+        self.messages = []
+        self.summary = ""
@@ -1,81 +1,238 @@
 """
 Langchain agent
 """
-from typing import Generator, Dict, Optional, Literal, TypedDict, List, Any
+import asyncio
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import aclosing, closing
+from functools import partial
+from typing import AsyncGenerator, AsyncIterator, Generator, Iterator, Dict, Optional, Literal, List, Any, Tuple
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 
-from langchain_groq import ChatGroq
-from langchain.memory import ConversationBufferMemory
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import BaseMessage
-from langchain_core.runnables import RunnablePassthrough, RunnableLambda, RunnableSerializable
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig, RunnablePassthrough, RunnableLambda, RunnableSerializable
 from langchain_core.output_parsers import StrOutputParser
 
-from .prompts import SYSTEM_PROMPT, REFERENCE_SYSTEM_PROMPT
+from .clients import create_chat_model
+from .coalesce import CoalescedRunnable
+from .compaction import CompactionPolicy, CompactionWindow, ResponseCompactor, format_responses
+from .convergence import ConvergencePolicy, agreement, term_counts
+from .failover import CircuitBreakerPolicy, FailoverRunnable, HedgePolicy, ModelHealth, get_default_health
+from .cache import BaseCache, CachedRunnable, cache_from_config
+from .instrumentation import InstrumentedRunnable, MetricsSink, Trace, trace_config
+from .memory import DEFAULT_CONTEXT_WINDOW, BoundedConversationMemory, HistoryIndex, HistoryPolicy, HistoryWindow, context_window
+from .prompts import SYSTEM_PROMPT, REFERENCE_SYSTEM_PROMPT, SUMMARY_PROMPT, COMPACTION_PROMPT, ROUTER_PROMPT
+from .replay import RecordingRunnable, TrafficRecorder, recorder_from_config, traffic_params
+from .router import Router, RoutingPolicy
+from .store import ConversationStore, StoredConversationMemory, store_from_config
+from .scheduler import ModelScheduler, ScheduledRunnable, get_default_scheduler
+from .types import MOAgentConfig, ResponseChunk, valid_model_names
 
+load_dotenv()
 
+DEFAULT_LAYER_AGENT_CONFIG = {
+    'layer_agent_1' : {'system_prompt': SYSTEM_PROMPT, 'model_name': 'llama3-8b-8192'},
+    'layer_agent_2' : {'system_prompt': SYSTEM_PROMPT, 'model_name': 'gemma-7b-it'},
+    'layer_agent_3' : {'system_prompt': SYSTEM_PROMPT, 'model_name': 'mixtral-8x7b-32768'}
+}
 
-class MOAgentConfig(BaseModel):
-    main_model: Optional[str] = None
-    system_prompt: Optional[str] = None
-    cycles: int = Field(...)
-    layer_agent_config: Optional[Dict[str, Any]] = None
-    reference_system_prompt: Optional[str] = None
-    max_tokens: Optional[int] = None
+# Keys of a layer agent's config consumed by MOAgent rather than passed on to ChatGroq
+LAYER_AGENT_OPTIONS = ('deadline',)
 
-    class Config:
-        extra = "allow"  # This allows for additional fields not explicitly defined
 
-load_dotenv()
-valid_model_names = Literal[
-    'llama3-70b-8192',
-    'llama3-8b-8192',
-    'gemma-7b-it',
-    'gemma2-9b-it',
-    'mixtral-8x7b-32768',
-    'llama-3.1-8b-instant',
-    'llama-3.1-70b-versatile'
-]
-
-class ResponseChunk(TypedDict):
-    delta: str
-    response_type: Literal['intermediate', 'output']
-    metadata: Dict[str, Any]
+class LayerPolicy(BaseModel):
+    """When a cycle may proceed without waiting for every layer agent.
+
+    A layer completes once ``quorum`` agents have answered, or once ``timeout``
+    seconds have passed and at least one agent has answered. Agents listed in
+    ``agent_timeouts`` are cut off individually after their own deadline.
+    Agents still running when the layer completes are cancelled (``'drop'``)
+    or left running and counted towards the next cycle (``'next_cycle'``).
+    """
+    quorum: Optional[int] = None
+    timeout: Optional[float] = None
+    agent_timeouts: Dict[str, float] = Field(default_factory=dict)
+    late_responses: Literal['drop', 'next_cycle'] = 'drop'
+
+    def wait_timeout(self, elapsed: float, answered: int, pending: List[str]) -> Optional[float]:
+        """Seconds until the next deadline among ``pending`` agents, or ``None`` to block."""
+        deadlines = [self.agent_timeouts[key] for key in pending if key in self.agent_timeouts]
+        if self.timeout is not None and answered:
+            deadlines.append(self.timeout)
+        return max(0.0, min(deadlines) - elapsed) if deadlines else None
+
+    def is_complete(self, elapsed: float, answered: int) -> bool:
+        if self.quorum is not None and answered >= self.quorum:
+            return True
+        return self.timeout is not None and answered > 0 and elapsed >= self.timeout
+
+    def expired(self, elapsed: float, pending: List[str]) -> List[str]:
+        return [
+            key for key in pending
+            if key in self.agent_timeouts and elapsed >= self.agent_timeouts[key]
+        ]
+
+
+class ExecutionPlan(BaseModel):
+    """Which layer agents run in each cycle.
+
+    Cycle ``n`` runs the agents of ``layers[n - 1]``; cycles past the last layer
+    repeat it. Built from a list of per-layer agent configs, e.g. a wide layer of
+    small models followed by a narrow layer of strong ones.
+    """
+    layers: List[List[str]]
+
+    @classmethod
+    def compile(cls, layers: List[Dict[str, Dict[str, Any]]]) -> Tuple["ExecutionPlan", Dict[str, Dict[str, Any]]]:
+        """The plan for ``layers`` and the merged config of every agent it uses, each compiled once."""
+        agents: Dict[str, Dict[str, Any]] = {}
+        for n, layer in enumerate(layers, 1):
+            if not layer:
+                raise ValueError(f"Layer {n} has no agents")
+            for key, config in layer.items():
+                if agents.setdefault(key, config) != config:
+                    raise ValueError(f"Layer agent {key!r} is configured differently in layer {n}; rename one of them")
+        return cls(layers=[list(layer) for layer in layers]), agents
+
+    def agents(self, layer: int) -> List[str]:
+        return self.layers[min(layer, len(self.layers)) - 1]
+
+
+class AgentChain(Runnable[Dict[str, Any], str]):
+    """An agent's prompt preparation followed by its model.
+
+    Equivalent to ``prepare | model``, but streams straight from ``model`` so that
+    closing a stream closes the model call at once instead of when LangChain's
+    sequence is garbage collected.
+    """
+
+    def __init__(self, prepare: Runnable[Dict[str, Any], PromptValue], model: Runnable[PromptValue, str]) -> None:
+        self.prepare = prepare
+        self.model = model
+
+    def invoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        return self.model.invoke(self.prepare.invoke(input, config), config, **kwargs)
+
+    async def ainvoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        return await self.model.ainvoke(await self.prepare.ainvoke(input, config), config, **kwargs)
+
+    def stream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[str]:
+        with closing(self.model.stream(self.prepare.invoke(input, config), config, **kwargs)) as stream:
+            yield from stream
+
+    async def astream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[str]:
+        prompt = await self.prepare.ainvoke(input, config)
+        async with aclosing(self.model.astream(prompt, config, **kwargs)) as stream:
+            async for chunk in stream:
+                yield chunk
 
 
 class MOAgent:
     def __init__(
         self,
-        main_agent: RunnableSerializable[Dict, str],
+        main_agent: Runnable[Dict, str],
         layer_agent: RunnableSerializable[Dict, Dict],
         reference_system_prompt: Optional[str] = None,
         cycles: Optional[int] = None,
-        chat_memory: Optional[ConversationBufferMemory] = None
+        chat_memory: Optional[BoundedConversationMemory] = None,
+        layer_agents: Optional[Dict[str, Runnable[Dict, str]]] = None,
+        layer_policy: Optional[LayerPolicy] = None,
+        sinks: Optional[List[MetricsSink]] = None,
+        convergence: Optional[ConvergencePolicy] = None,
+        compactor: Optional[ResponseCompactor] = None,
+        router: Optional[Router] = None,
+        state_store: Optional[ConversationStore] = None,
+        plan: Optional[ExecutionPlan] = None
     ) -> None:
         self.reference_system_prompt = reference_system_prompt or REFERENCE_SYSTEM_PROMPT
         self.main_agent = main_agent
         self.layer_agent = layer_agent
+        self.layer_agents = layer_agents
+        self.layer_policy = layer_policy or LayerPolicy()
+        self.sinks = sinks or []
+        self.convergence = convergence or ConvergencePolicy()
+        self.compactor = compactor
+        self.router = router
+        self.state_store = state_store
+        self.plan = plan
         self.cycles = cycles or 1
-        self.chat_memory = chat_memory or ConversationBufferMemory(
-            memory_key="messages",
-            return_messages=True
+        self.chat_memory = chat_memory or BoundedConversationMemory(memory_key="messages")
+
+    def spawn(self, chat_memory: Optional[BoundedConversationMemory] = None) -> "MOAgent":
+        """New conversation sharing this agent's compiled chains, with its own memory."""
+        if chat_memory is None:
+            chat_memory = BoundedConversationMemory(
+                max_token_limit=getattr(self.chat_memory, 'max_token_limit', DEFAULT_CONTEXT_WINDOW),
+                summarizer=getattr(self.chat_memory, 'summarizer', None),
+                memory_key=getattr(self.chat_memory, 'memory_key', "messages")
+            )
+        return MOAgent(
+            main_agent=self.main_agent,
+            layer_agent=self.layer_agent,
+            reference_system_prompt=self.reference_system_prompt,
+            cycles=self.cycles,
+            chat_memory=chat_memory,
+            layer_agents=self.layer_agents,
+            layer_policy=self.layer_policy,
+            sinks=self.sinks,
+            convergence=self.convergence,
+            compactor=self.compactor,
+            router=self.router,
+            state_store=self.state_store,
+            plan=self.plan
         )
 
+    def conversation(self, conversation_id: str, store: Optional[ConversationStore] = None) -> "MOAgent":
+        """Handle on a conversation persisted in ``store`` (the configured state store by default).
+
+        Any process sharing the store can serve the next turn of the conversation.
+        """
+        store = store or self.state_store
+        if store is None:
+            raise ValueError("No state store configured for persisted conversations")
+        return self.spawn(StoredConversationMemory(
+            store,
+            conversation_id,
+            max_token_limit=getattr(self.chat_memory, 'max_token_limit', DEFAULT_CONTEXT_WINDOW),
+            summarizer=getattr(self.chat_memory, 'summarizer', None),
+            memory_key=getattr(self.chat_memory, 'memory_key', "messages")
+        ))
+
     @staticmethod
     def concat_response(
         inputs: Dict[str, str],
-        reference_system_prompt: Optional[str] = None
+        reference_system_prompt: Optional[str] = None,
+        compactor: Optional[ResponseCompactor] = None
+    ):
+        reference_system_prompt = reference_system_prompt or REFERENCE_SYSTEM_PROMPT
+
+        res_list = list(inputs.values())
+        if compactor is not None:
+            res_list = compactor.compact(res_list)
+
+        formatted_prompt = format_responses(reference_system_prompt, res_list)
+        return {
+            'formatted_response': formatted_prompt,
+            'responses': res_list
+        }
+
+    @staticmethod
+    async def aconcat_response(
+        inputs: Dict[str, str],
+        reference_system_prompt: Optional[str] = None,
+        compactor: Optional[ResponseCompactor] = None
     ):
         reference_system_prompt = reference_system_prompt or REFERENCE_SYSTEM_PROMPT
 
-        responses = ""
-        res_list = []
-        for i, out in enumerate(inputs.values()):
-            responses += f"{i}. {out}\n"
-            res_list.append(out)
+        res_list = list(inputs.values())
+        if compactor is not None:
+            res_list = await compactor.acompact(res_list)
 
-        formatted_prompt = reference_system_prompt.format(responses=responses)
+        formatted_prompt = format_responses(reference_system_prompt, res_list)
         return {
             'formatted_response': formatted_prompt,
             'responses': res_list
@@ -89,52 +246,195 @@ class MOAgent:
         cycles: int = 1,
         layer_agent_config: Optional[Dict] = None,
         reference_system_prompt: Optional[str] = None,
+        layer_policy: Optional[Dict[str, Any] | LayerPolicy] = None,
+        response_cache: Optional[BaseCache | Dict[str, Any] | bool] = None,
+        memory_max_tokens: Optional[int] = None,
+        summary_model: Optional[valid_model_names] = None,
+        scheduler: Optional[ModelScheduler] = None,
+        sinks: Optional[List[MetricsSink]] = None,
+        convergence: Optional[ConvergencePolicy | Dict[str, Any] | float] = None,
+        compaction: Optional[CompactionPolicy | Dict[str, Any]] = None,
+        routing: Optional[RoutingPolicy | Dict[str, Any] | bool] = None,
+        state_store: Optional[ConversationStore | Dict[str, Any]] = None,
+        coalesce: bool = True,
+        fallbacks: Optional[List[str]] = None,
+        hedge: Optional[HedgePolicy | Dict[str, Any] | bool | float] = None,
+        circuit_breaker: Optional[CircuitBreakerPolicy | Dict[str, Any]] = None,
+        health: Optional[ModelHealth] = None,
+        record_traffic: Optional[TrafficRecorder | str] = None,
+        layers: Optional[List[Dict[str, Any]]] = None,
         **main_model_kwargs
     ):
+        plan = None
+        if layers and layer_agent_config:
+            raise ValueError("Give either layers or layer_agent_config, not both")
+        if layers:
+            # Per-layer configs replace layer_agent_config; agents shared by several layers are compiled once
+            plan, layer_agent_config = ExecutionPlan.compile(layers)
+            cycles = max(cycles, len(plan.layers))
         reference_system_prompt = reference_system_prompt or REFERENCE_SYSTEM_PROMPT
         system_prompt = system_prompt or SYSTEM_PROMPT
-        layer_agent = MOAgent._configure_layer_agent(layer_agent_config)
+        # A copy, since per-agent deadlines are filled in below and the caller's policy may be shared
+        layer_policy = LayerPolicy.model_validate(layer_policy or {}).model_copy(deep=True)
+        for key, value in (layer_agent_config or {}).items():
+            if value.get('deadline') is not None:
+                layer_policy.agent_timeouts.setdefault(key, value['deadline'])
+        scheduler = scheduler or get_default_scheduler()
+        if health is None:
+            health = get_default_health() if circuit_breaker is None else ModelHealth(
+                CircuitBreakerPolicy.from_config(circuit_breaker)
+            )
+        recorder = recorder_from_config(record_traffic)
+        compaction = CompactionPolicy.from_config(compaction)
+        compaction_summarizer = None
+        if compaction.method == 'llm':
+            compaction_summarizer = ChatPromptTemplate.from_template(COMPACTION_PROMPT) | create_chat_model(
+                compaction.model or summary_model or main_model, temperature=0
+            ) | StrOutputParser()
+        compactor = ResponseCompactor(compaction, summarizer=compaction_summarizer)
+        layer_agents = MOAgent._create_layer_agents(
+            layer_agent_config,
+            response_cache=response_cache,
+            scheduler=scheduler,
+            coalesce=coalesce,
+            hedge=hedge,
+            health=health,
+            recorder=recorder,
+            compactor=compactor,
+            reference_system_prompt=reference_system_prompt
+        )
+        layer_agent = MOAgent._configure_layer_agent(
+            layer_agents=layer_agents,
+            reference_system_prompt=reference_system_prompt,
+            compactor=compactor
+        )
         main_agent = MOAgent._create_agent_from_system_prompt(
             system_prompt=system_prompt,
             model_name=main_model,
+            response_cache=response_cache,
+            scheduler=scheduler,
+            coalesce=coalesce,
+            fallbacks=fallbacks,
+            hedge=hedge,
+            health=health,
+            recorder=recorder,
+            compactor=compactor,
+            reference_system_prompt=reference_system_prompt,
             **main_model_kwargs
         )
+        summarizer = None
+        if summary_model:
+            summarizer = ChatPromptTemplate.from_template(SUMMARY_PROMPT) | create_chat_model(
+                summary_model, temperature=0
+            ) | StrOutputParser()
+        chat_memory = BoundedConversationMemory(
+            max_token_limit=memory_max_tokens or context_window(main_model),
+            summarizer=summarizer
+        )
+        router = None
+        routing = RoutingPolicy.from_config(routing)
+        if routing is not None:
+            classifier = None
+            if routing.classifier_model:
+                classifier = ChatPromptTemplate.from_template(ROUTER_PROMPT) | create_chat_model(
+                    routing.classifier_model, temperature=0, max_tokens=4
+                ) | StrOutputParser()
+            router = Router(
+                agent_models={
+                    key: value.get('model_name', 'llama3-8b-8192')
+                    for key, value in (layer_agent_config or DEFAULT_LAYER_AGENT_CONFIG).items()
+                },
+                policy=routing,
+                classifier=classifier
+            )
+            # The router learns agent latencies and token usage from every finished turn
+            sinks = [*(sinks or []), router.profiles]
         return cls(
             main_agent=main_agent,
             layer_agent=layer_agent,
             reference_system_prompt=reference_system_prompt,
-            cycles=cycles
+            cycles=cycles,
+            layer_agents=layer_agents,
+            layer_policy=layer_policy,
+            chat_memory=chat_memory,
+            sinks=sinks,
+            convergence=ConvergencePolicy.from_config(convergence),
+            compactor=compactor,
+            router=router,
+            state_store=store_from_config(state_store),
+            plan=plan
         )
 
     @staticmethod
-    def _configure_layer_agent(
-        layer_agent_config: Optional[Dict] = None
-    ) -> RunnableSerializable[Dict, Dict]:
-        if not layer_agent_config:
-            layer_agent_config = {
-                'layer_agent_1' : {'system_prompt': SYSTEM_PROMPT, 'model_name': 'llama3-8b-8192'},
-                'layer_agent_2' : {'system_prompt': SYSTEM_PROMPT, 'model_name': 'gemma-7b-it'},
-                'layer_agent_3' : {'system_prompt': SYSTEM_PROMPT, 'model_name': 'mixtral-8x7b-32768'}
-            }
+    def _create_layer_agents(
+        layer_agent_config: Optional[Dict] = None,
+        response_cache: Optional[BaseCache | Dict[str, Any] | bool] = None,
+        scheduler: Optional[ModelScheduler] = None,
+        coalesce: bool = False,
+        hedge: Optional[HedgePolicy | Dict[str, Any] | bool | float] = None,
+        health: Optional[ModelHealth] = None,
+        recorder: Optional[TrafficRecorder] = None,
+        compactor: Optional[ResponseCompactor] = None,
+        reference_system_prompt: Optional[str] = None
+    ) -> Dict[str, Runnable[Dict, str]]:
+        layer_agent_config = layer_agent_config or DEFAULT_LAYER_AGENT_CONFIG
 
-        parallel_chain_map = dict()
+        layer_agents = dict()
         for key, value in layer_agent_config.items():
-            chain = MOAgent._create_agent_from_system_prompt(
+            value = dict(value)
+            for option in LAYER_AGENT_OPTIONS:
+                value.pop(option, None)
+            layer_agents[key] = MOAgent._create_agent_from_system_prompt(
                 system_prompt=value.pop("system_prompt", SYSTEM_PROMPT), 
                 model_name=value.pop("model_name", 'llama3-8b-8192'),
+                response_cache=value.pop("response_cache", response_cache),
+                history=value.pop("history", None),
+                scheduler=scheduler,
+                coalesce=value.pop("coalesce", coalesce),
+                fallbacks=value.pop("fallbacks", None),
+                hedge=value.pop("hedge", hedge),
+                health=health,
+                recorder=recorder,
+                compactor=compactor,
+                reference_system_prompt=reference_system_prompt,
                 **value
             )
-            parallel_chain_map[key] = RunnablePassthrough() | chain
-        
-        chain = parallel_chain_map | RunnableLambda(MOAgent.concat_response)
+        return layer_agents
+
+    @staticmethod
+    def _configure_layer_agent(
+        layer_agent_config: Optional[Dict] = None,
+        layer_agents: Optional[Dict[str, Runnable[Dict, str]]] = None,
+        reference_system_prompt: Optional[str] = None,
+        compactor: Optional[ResponseCompactor] = None
+    ) -> RunnableSerializable[Dict, Dict]:
+        layer_agents = layer_agents or MOAgent._create_layer_agents(layer_agent_config)
+        parallel_chain_map = {
+            key: RunnablePassthrough() | chain
+            for key, chain in layer_agents.items()
+        }
+        chain = parallel_chain_map | RunnableLambda(
+            partial(MOAgent.concat_response, reference_system_prompt=reference_system_prompt, compactor=compactor),
+            afunc=partial(MOAgent.aconcat_response, reference_system_prompt=reference_system_prompt, compactor=compactor)
+        )
         return chain
 
     @staticmethod
     def _create_agent_from_system_prompt(
         system_prompt: str = SYSTEM_PROMPT,
         model_name: str = "llama3-8b-8192",
+        response_cache: Optional[BaseCache | Dict[str, Any] | bool] = None,
+        history: Optional[HistoryPolicy | Dict[str, Any] | int] = None,
+        scheduler: Optional[ModelScheduler] = None,
+        coalesce: bool = False,
+        fallbacks: Optional[List[str]] = None,
+        hedge: Optional[HedgePolicy | Dict[str, Any] | bool | float] = None,
+        health: Optional[ModelHealth] = None,
+        recorder: Optional[TrafficRecorder] = None,
+        compactor: Optional[ResponseCompactor] = None,
+        reference_system_prompt: Optional[str] = None,
         **llm_kwargs
-    ) -> RunnableSerializable[Dict, str]:
+    ) -> Runnable[Dict, str]:
         prompt = ChatPromptTemplate.from_messages([
             ("system", system_prompt),
             MessagesPlaceholder(variable_name="messages", optional=True),
@@ -142,10 +442,280 @@ class MOAgent:
         ])
 
         assert 'helper_response' in prompt.input_variables
-        llm = ChatGroq(model=model_name, **llm_kwargs)
-        
-        chain = prompt | llm | StrOutputParser()
-        return chain
+        params = {'model': model_name, **llm_kwargs}
+        if scheduler is not None:
+            # Retries are handled by the scheduler with jittered backoff
+            llm_kwargs.setdefault('max_retries', 0)
+
+        def create_model(name: str, retry: bool = True) -> Runnable[PromptValue, str]:
+            model = create_chat_model(name, **llm_kwargs) | StrOutputParser()
+            if recorder is not None:
+                # Innermost, so every upstream attempt is recorded, retries and fallbacks included
+                model = RecordingRunnable(model, recorder, params=traffic_params(name, llm_kwargs))
+            if scheduler is not None:
+                model = ScheduledRunnable(
+                    model,
+                    scheduler=scheduler,
+                    model_name=name,
+                    max_tokens=llm_kwargs.get('max_tokens'),
+                    max_retries=None if retry else 0
+                )
+            return model
+
+        hedge = HedgePolicy.from_config(hedge)
+        if fallbacks or hedge is not None:
+            # Each fallback gets its own rate limits; the circuit breakers are shared process-wide.
+            # Only the last candidate is retried, the others fail over at once.
+            names = [model_name, *(fallbacks or [])]
+            model = FailoverRunnable(
+                [(name, create_model(name, retry=i == len(names) - 1)) for i, name in enumerate(names)],
+                health=health,
+                hedge=hedge
+            )
+        else:
+            model = create_model(model_name)
+
+        if coalesce:
+            # Identical requests in flight at the same time share one upstream call
+            model = CoalescedRunnable(model, params=params)
+
+        response_cache = cache_from_config(response_cache)
+        if response_cache is not None:
+            model = CachedRunnable(model, cache=response_cache, params=params)
+        model = InstrumentedRunnable(model, model_name=model_name)
+
+        window = HistoryWindow(
+            model_name=model_name,
+            system_prompt=system_prompt,
+            policy=HistoryPolicy.from_config(history),
+            completion_tokens=llm_kwargs.get('max_tokens')
+        )
+        prepare = RunnableLambda(window.apply, afunc=window.aapply) | prompt
+        if compactor is not None:
+            # Fit the layer responses first; the history window takes what is left
+            compaction = CompactionWindow(
+                compactor,
+                model_name=model_name,
+                system_prompt=system_prompt,
+                reference_system_prompt=reference_system_prompt or REFERENCE_SYSTEM_PROMPT,
+                completion_tokens=llm_kwargs.get('max_tokens')
+            )
+            prepare = RunnableLambda(compaction.apply, afunc=compaction.aapply) | prepare
+        return AgentChain(prepare, model)
+
+    def _ordered_outputs(self, outputs: Dict[str, str], layer: int = 1) -> Dict[str, str]:
+        """Put layer outputs back into configuration order, whatever order they finished in."""
+        order = self.plan.agents(layer) if self.plan is not None else list(self.layer_agents or outputs)
+        return {key: outputs[key] for key in order if key in outputs}
+
+    @staticmethod
+    def _layer_chunk(layer: int, agent: str, output: str, trace: Trace) -> ResponseChunk:
+        metadata = {'layer': layer, 'agent': agent}
+        spans = trace.agent_spans(layer, agent)
+        if spans:
+            span = spans[-1]
+            metadata['timing'] = {
+                'duration': span['duration'],
+                'prompt_tokens': span['prompt_tokens'],
+                'completion_tokens': span['completion_tokens']
+            }
+        return ResponseChunk(delta=output, response_type='intermediate', metadata=metadata)
+
+    def _export_trace(self, trace: Trace) -> Dict[str, Any]:
+        summary = trace.to_dict()
+        for sink in self.sinks:
+            sink.export(summary)
+        return summary
+
+    @staticmethod
+    def _cutoff_chunk(layer: int, agent: str) -> ResponseChunk:
+        return ResponseChunk(
+            delta="",
+            response_type='intermediate',
+            metadata={'layer': layer, 'agent': agent, 'cutoff': True}
+        )
+
+    @property
+    def _compares_terms(self) -> bool:
+        """Whether layer outputs are compared by their terms, for convergence or deduplication."""
+        return self.convergence.threshold is not None or (
+            self.compactor is not None and self.compactor.policy.dedupe_threshold is not None
+        )
+
+    def _select_agents(self, agents: Optional[List[str]] = None, layer: int = 1) -> Dict[str, Runnable[Dict, str]]:
+        """Agents of ``layer``, restricted to ``agents`` unless none of them is in the layer."""
+        keys = self.plan.agents(layer) if self.plan is not None else list(self.layer_agents)
+        selected = [key for key in keys if agents is None or key in agents] or keys
+        return {key: self.layer_agents[key] for key in selected}
+
+    @staticmethod
+    def _stream_until(
+        agent: Runnable[Dict, str],
+        llm_inp: Dict[str, Any],
+        config: Dict[str, Any],
+        cancelled: threading.Event
+    ) -> Optional[str]:
+        """Stream ``agent``'s answer, dropping the request as soon as ``cancelled`` is set.
+
+        A thread can't be interrupted, so layer agents run in the pool stream their
+        answers and check ``cancelled`` between chunks instead of blocking in ``invoke``.
+        """
+        if cancelled.is_set():
+            return None
+        output = ""
+        with closing(agent.stream(llm_inp, config)) as stream:
+            for chunk in stream:
+                if cancelled.is_set():
+                    return None
+                output += chunk
+        return output
+
+    @staticmethod
+    async def _astream_agent(agent: Runnable[Dict, str], llm_inp: Dict[str, Any], config: Dict[str, Any]) -> str:
+        """Stream ``agent``'s answer so that a cancelled call still records its partial output."""
+        output = ""
+        async with aclosing(agent.astream(llm_inp, config)) as stream:
+            async for chunk in stream:
+                output += chunk
+        return output
+
+    def _iter_layer(
+        self,
+        llm_inp: Dict[str, Any],
+        carried: Optional[Dict[str, Tuple[Future, threading.Event]]] = None,
+        carry: bool = False,
+        trace: Optional[Trace] = None,
+        layer: int = 1,
+        agents: Optional[List[str]] = None
+    ) -> Iterator[Tuple[str, Optional[str]]]:
+        """Run one layer in a thread pool, yielding ``(agent, output)`` as each agent finishes.
+
+        Agents cut off by the layer policy are yielded with a ``None`` output. With
+        ``carry``, their futures (and cancel events) are left running in ``carried``
+        for the next cycle instead of being cancelled; those already in ``carried``
+        are reused. Closing the iterator cancels every call still in flight.
+        ``agents`` restricts the layer to a subset of the layer agents.
+        """
+        if not self.layer_agents:
+            layer_output = self.layer_agent.invoke(llm_inp, trace_config(trace, layer=layer))
+            for i, out in enumerate(layer_output['responses']):
+                yield f"layer_agent_{i + 1}", out
+            return
+
+        carried = carried if carried is not None else {}
+        policy = self.layer_policy
+        layer_agents = self._select_agents(agents, layer)
+        for key in [key for key in carried if key not in layer_agents]:
+            # Carried over from a previous layer whose agent doesn't run in this one
+            future, cancelled = carried.pop(key)
+            future.cancel()
+            cancelled.set()
+        executor = ThreadPoolExecutor(max_workers=len(layer_agents))
+        calls = {}
+        for key, agent in layer_agents.items():
+            if key not in carried:
+                cancelled = threading.Event()
+                future = executor.submit(
+                    self._stream_until, agent, llm_inp, trace_config(trace, agent=key, layer=layer), cancelled
+                )
+                carried[key] = (future, cancelled)
+            calls[key] = carried.pop(key)
+        futures = {future: key for key, (future, _) in calls.items()}
+        pending = set(futures)
+        start = time.monotonic()
+        answered = 0
+        late = set()
+        try:
+            while pending and not policy.is_complete(time.monotonic() - start, answered):
+                timeout = policy.wait_timeout(
+                    time.monotonic() - start, answered, [futures[f] for f in pending]
+                )
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    answered += 1
+                    yield futures[future], future.result()
+
+                expired = policy.expired(time.monotonic() - start, [futures[f] for f in pending])
+                for future in [f for f in pending if futures[f] in expired]:
+                    pending.discard(future)
+                    late.add(future)
+                    yield futures[future], None
+
+            for future in pending:
+                yield futures[future], None
+            late |= pending
+            pending = set()
+            if carry and policy.late_responses == 'next_cycle':
+                carried.update({futures[f]: calls[futures[f]] for f in late})
+                late = set()
+        finally:
+            for future in pending | late:
+                future.cancel()
+                calls[futures[future]][1].set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _aiter_layer(
+        self,
+        llm_inp: Dict[str, Any],
+        carried: Optional[Dict[str, asyncio.Future]] = None,
+        carry: bool = False,
+        trace: Optional[Trace] = None,
+        layer: int = 1,
+        agents: Optional[List[str]] = None
+    ) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        """Async counterpart of ``_iter_layer`` running every agent on the event loop."""
+        if not self.layer_agents:
+            layer_output = await self.layer_agent.ainvoke(llm_inp, trace_config(trace, layer=layer))
+            for i, out in enumerate(layer_output['responses']):
+                yield f"layer_agent_{i + 1}", out
+            return
+
+        carried = carried if carried is not None else {}
+        policy = self.layer_policy
+        layer_agents = self._select_agents(agents, layer)
+        for key in [key for key in carried if key not in layer_agents]:
+            carried.pop(key).cancel()
+        tasks = {
+            carried.pop(key, None) or asyncio.ensure_future(
+                self._astream_agent(agent, llm_inp, trace_config(trace, agent=key, layer=layer))
+            ): key
+            for key, agent in layer_agents.items()
+        }
+        pending = set(tasks)
+        start = time.monotonic()
+        answered = 0
+        late = set()
+        try:
+            while pending and not policy.is_complete(time.monotonic() - start, answered):
+                timeout = policy.wait_timeout(
+                    time.monotonic() - start, answered, [tasks[t] for t in pending]
+                )
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    answered += 1
+                    yield tasks[task], task.result()
+
+                expired = policy.expired(time.monotonic() - start, [tasks[t] for t in pending])
+                for task in [t for t in pending if tasks[t] in expired]:
+                    pending.discard(task)
+                    late.add(task)
+                    yield tasks[task], None
+
+            for task in pending:
+                yield tasks[task], None
+            late |= pending
+            pending = set()
+            if carry and policy.late_responses == 'next_cycle':
+                carried.update({tasks[t]: t for t in late})
+                late = set()
+        finally:
+            for task in pending | late:
+                task.cancel()
+            if pending | late:
+                # Let the cancelled calls record their partial usage before the trace is exported
+                await asyncio.wait(pending | late)
 
     def chat(
         self, 
@@ -153,45 +723,225 @@ class MOAgent:
         messages: Optional[List[BaseMessage]] = None,
         cycles: Optional[int] = None,
         save: bool = True,
-        output_format: Literal['string', 'json'] = 'string'
+        output_format: Literal['string', 'json'] = 'string',
+        stream_layers: bool = False
     ) -> Generator[str | ResponseChunk, None, None]:
+        """Run the layer cycles and stream the main agent's answer.
+
+        With ``stream_layers`` each intermediate chunk is yielded as soon as its
+        layer agent finishes rather than once the whole layer has completed. In
+        ``json`` format a final empty output chunk carries the turn's trace.
+
+        Closing the generator early aborts the layer calls and the main agent's
+        stream still in flight. The turn is then not saved to memory, and its
+        trace is exported with ``cancelled`` set and the usage so far.
+        """
         cycles = cycles or self.cycles
-        llm_inp = {
+        route = self.router.route(input, cycles) if self.router is not None and self.layer_agents else None
+        cycles = route.cycles if route is not None else cycles
+        trace = Trace(cycles=cycles, cycles_skipped=0)
+        if route is not None:
+            trace.attributes['route'] = route.model_dump()
+        messages = messages or self.chat_memory.load_memory_variables({})['messages']
+        # Memory is read and the history indexed once; every agent of every cycle trims the same index
+        turn = {
             'input': input,
-            'messages': messages or self.chat_memory.load_memory_variables({})['messages'],
-            'helper_response': ""
+            'messages': messages,
+            'history_index': HistoryIndex(messages)
         }
-        for cyc in range(cycles):
-            layer_output = self.layer_agent.invoke(llm_inp)
-            l_frm_resp = layer_output['formatted_response']
-            l_resps = layer_output['responses']
-            
-            llm_inp = {
-                'input': input,
-                'messages': self.chat_memory.load_memory_variables({})['messages'],
-                'helper_response': l_frm_resp
-            }
+        llm_inp = {**turn, 'helper_response': ""}
+        carried = {}
+        try:
+            for cyc in range(cycles):
+                outputs, cutoff = {}, []
+                layer = self._iter_layer(
+                    llm_inp,
+                    carried,
+                    carry=cyc < cycles - 1,
+                    trace=trace,
+                    layer=cyc + 1,
+                    agents=route.agents if route is not None else None
+                )
+                with trace.span('layer', layer=cyc + 1) as layer_span, closing(layer):
+                    for key, l_out in layer:
+                        if l_out is None:
+                            cutoff.append(key)
+                            if output_format == 'json' and stream_layers:
+                                yield self._cutoff_chunk(cyc + 1, key)
+                            continue
+                        outputs[key] = l_out
+                        if self._compares_terms:
+                            # Count its terms for agreement and deduplication while the rest of the layer streams
+                            term_counts(l_out)
+                        if output_format == 'json' and stream_layers:
+                            yield self._layer_chunk(cyc + 1, key, l_out, trace)
+                    layer_span['cutoff'] = cutoff
 
-            if output_format == 'json':
-                for l_out in l_resps:
-                    yield ResponseChunk(
-                        delta=l_out,
-                        response_type='intermediate',
-                        metadata={'layer': cyc + 1}
-                    )
-
-        stream = self.main_agent.stream(llm_inp)
-        response = ""
-        for chunk in stream:
-            if output_format == 'json':
-                    yield ResponseChunk(
-                        delta=chunk,
-                        response_type='output',
-                        metadata={}
-                    )
-            else:
-                yield chunk
-            response += chunk
+                with trace.span('concat', layer=cyc + 1) as concat_span:
+                    outputs = self._ordered_outputs(outputs, cyc + 1)
+                    layer_output = self.concat_response(outputs, self.reference_system_prompt, self.compactor)
+                    if self.convergence.threshold is not None:
+                        concat_span['agreement'] = agreement(list(outputs.values()))
+                llm_inp = {
+                    **turn,
+                    'helper_response': layer_output['formatted_response'],
+                    'responses': layer_output['responses']
+                }
+
+                if output_format == 'json' and not stream_layers:
+                    for key, l_out in outputs.items():
+                        yield self._layer_chunk(cyc + 1, key, l_out, trace)
+                    for key in cutoff:
+                        yield self._cutoff_chunk(cyc + 1, key)
+
+                if cyc + 1 < cycles and self.convergence.converged(cyc + 1, concat_span.get('agreement')):
+                    trace.attributes['cycles_skipped'] = cycles - cyc - 1
+                    break
+
+            # Easy queries routed straight to a single layer agent skip the main agent
+            main_key = route.direct if route is not None and route.direct else 'main'
+            main_agent = self.layer_agents[main_key] if main_key != 'main' else self.main_agent
+            response = ""
+            with trace.span('main', agent=main_key) as main_span:
+                start = time.time()
+                stream = main_agent.stream(llm_inp, trace_config(trace, agent=main_key))
+                with closing(stream):
+                    for chunk in stream:
+                        main_span.setdefault('ttft', time.time() - start)
+                        if output_format == 'json':
+                            yield ResponseChunk(
+                                delta=chunk,
+                                response_type='output',
+                                metadata={}
+                            )
+                        else:
+                            yield chunk
+                        response += chunk
+        except GeneratorExit:
+            # The consumer went away: report the usage so far and don't remember a partial answer
+            trace.attributes['cancelled'] = True
+            self._export_trace(trace)
+            raise
+        finally:
+            for future, cancelled in carried.values():
+                future.cancel()
+                cancelled.set()
+
+        if save:
+            self.chat_memory.save_context({'input': input}, {'output': response})
+
+        summary = self._export_trace(trace)
+        if output_format == 'json':
+            yield ResponseChunk(delta="", response_type='output', metadata={'trace': summary})
+
+    async def achat(
+        self,
+        input: str,
+        messages: Optional[List[BaseMessage]] = None,
+        cycles: Optional[int] = None,
+        save: bool = True,
+        output_format: Literal['string', 'json'] = 'string',
+        stream_layers: bool = False
+    ) -> AsyncGenerator[str | ResponseChunk, None]:
+        """Async counterpart of ``chat``.
+
+        Layer agents of a cycle are fanned out concurrently with ``ainvoke`` and
+        the main agent is streamed with ``astream``, so many conversations can
+        share one event loop instead of holding a thread each. Cancelling the task
+        or closing the generator aborts the turn as in ``chat``.
+        """
+        cycles = cycles or self.cycles
+        route = await self.router.aroute(input, cycles) if self.router is not None and self.layer_agents else None
+        cycles = route.cycles if route is not None else cycles
+        trace = Trace(cycles=cycles, cycles_skipped=0)
+        if route is not None:
+            trace.attributes['route'] = route.model_dump()
+        messages = messages or (await self.chat_memory.aload_memory_variables({}))['messages']
+        # Memory is read and the history indexed once; every agent of every cycle trims the same index
+        turn = {
+            'input': input,
+            'messages': messages,
+            'history_index': HistoryIndex(messages)
+        }
+        llm_inp = {**turn, 'helper_response': ""}
+        carried = {}
+        try:
+            for cyc in range(cycles):
+                outputs, cutoff = {}, []
+                layer = self._aiter_layer(
+                    llm_inp,
+                    carried,
+                    carry=cyc < cycles - 1,
+                    trace=trace,
+                    layer=cyc + 1,
+                    agents=route.agents if route is not None else None
+                )
+                with trace.span('layer', layer=cyc + 1) as layer_span:
+                    async with aclosing(layer):
+                        async for key, l_out in layer:
+                            if l_out is None:
+                                cutoff.append(key)
+                                if output_format == 'json' and stream_layers:
+                                    yield self._cutoff_chunk(cyc + 1, key)
+                                continue
+                            outputs[key] = l_out
+                            if self._compares_terms:
+                                term_counts(l_out)
+                            if output_format == 'json' and stream_layers:
+                                yield self._layer_chunk(cyc + 1, key, l_out, trace)
+                        layer_span['cutoff'] = cutoff
+
+                with trace.span('concat', layer=cyc + 1) as concat_span:
+                    outputs = self._ordered_outputs(outputs, cyc + 1)
+                    layer_output = await self.aconcat_response(outputs, self.reference_system_prompt, self.compactor)
+                    if self.convergence.threshold is not None:
+                        concat_span['agreement'] = agreement(list(outputs.values()))
+                llm_inp = {
+                    **turn,
+                    'helper_response': layer_output['formatted_response'],
+                    'responses': layer_output['responses']
+                }
+
+                if output_format == 'json' and not stream_layers:
+                    for key, l_out in outputs.items():
+                        yield self._layer_chunk(cyc + 1, key, l_out, trace)
+                    for key in cutoff:
+                        yield self._cutoff_chunk(cyc + 1, key)
+
+                if cyc + 1 < cycles and self.convergence.converged(cyc + 1, concat_span.get('agreement')):
+                    trace.attributes['cycles_skipped'] = cycles - cyc - 1
+                    break
+
+            main_key = route.direct if route is not None and route.direct else 'main'
+            main_agent = self.layer_agents[main_key] if main_key != 'main' else self.main_agent
+            response = ""
+            with trace.span('main', agent=main_key) as main_span:
+                start = time.time()
+                stream = main_agent.astream(llm_inp, trace_config(trace, agent=main_key))
+                async with aclosing(stream):
+                    async for chunk in stream:
+                        main_span.setdefault('ttft', time.time() - start)
+                        if output_format == 'json':
+                            yield ResponseChunk(
+                                delta=chunk,
+                                response_type='output',
+                                metadata={}
+                            )
+                        else:
+                            yield chunk
+                        response += chunk
+        except (GeneratorExit, asyncio.CancelledError):
+            # The consumer went away: report the usage so far and don't remember a partial answer
+            trace.attributes['cancelled'] = True
+            self._export_trace(trace)
+            raise
+        finally:
+            for task in carried.values():
+                task.cancel()
 
         if save:
-            self.chat_memory.save_context({'input': input}, {'output': response})
\ No newline at end of file
+            await self.chat_memory.asave_context({'input': input}, {'output': response})
+
+        summary = self._export_trace(trace)
+        if output_format == 'json':
+            yield ResponseChunk(delta="", response_type='output', metadata={'trace': summary})
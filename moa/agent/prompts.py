@@ -12,4 +12,35 @@ Your response should not simply replicate the given answers but should offer a r
 Ensure your response is well-structured, coherent, and adheres to the highest standards of accuracy and reliability.
 Responses from models:
 {responses}
-"""
\ No newline at end of file
+"""
+
+SUMMARY_PROMPT = """\
+Progressively summarize the lines of conversation provided, adding onto the previous summary and returning a new summary.
+Keep every fact, name and decision needed to continue the conversation.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:\
+"""
+
+COMPACTION_PROMPT = """\
+Condense the following response to at most {max_tokens} tokens.
+Keep its conclusions, key facts, figures and any code; drop repetition and filler.
+Reply with the condensed response only.
+
+Response:
+{response}
+"""
+
+ROUTER_PROMPT = """\
+Classify how much effort the following user query needs to answer well.
+Reply with exactly one word: simple (greetings, chit-chat, short factual questions), \
+moderate (explanations, everyday tasks) or hard (multi-step reasoning, math, code, analysis).
+
+Query:
+{input}
+"""
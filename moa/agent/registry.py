@@ -0,0 +1,113 @@
+"""
+Registry of compiled MoA pipelines keyed by configuration hash
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+from .types import MOAgentConfig
+
+if TYPE_CHECKING:
+    from .moa import MOAgent
+
+
+def canonical_config(config: MOAgentConfig | Dict[str, Any]) -> str:
+    """Stable JSON form of a configuration: sorted keys, unset and ``None`` fields dropped."""
+    if isinstance(config, MOAgentConfig):
+        config = config.model_dump(exclude_unset=True)
+    config = {k: v for k, v in config.items() if v is not None}
+    # Objects such as caches or sinks only compare equal to themselves
+    return json.dumps(config, sort_keys=True, default=lambda o: f"<{type(o).__name__}@{id(o):x}>")
+
+
+def config_hash(config: MOAgentConfig | Dict[str, Any]) -> str:
+    return hashlib.sha256(canonical_config(config).encode()).hexdigest()
+
+
+class AgentRegistry:
+    """Builds each distinct configuration once and hands out per-conversation handles.
+
+    Handles returned by ``get`` share the prompt templates, model clients and
+    layer chains of the compiled pipeline but each has its own memory. The
+    least recently used pipelines are evicted beyond ``maxsize``.
+    """
+
+    def __init__(self, maxsize: int = 32) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._pipelines: "OrderedDict[str, MOAgent]" = OrderedDict()
+        self._building: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def compiled(self, config: MOAgentConfig | Dict[str, Any]) -> "MOAgent":
+        """The shared pipeline for ``config``, building it on first use.
+
+        Pipelines are built outside the lock, so building one doesn't hold up
+        other configurations; concurrent callers for the same configuration
+        wait for the first one's build.
+        """
+        key = config_hash(config)
+        with self._lock:
+            pipeline = self._pipelines.get(key)
+            if pipeline is not None:
+                self.hits += 1
+                self._pipelines.move_to_end(key)
+                return pipeline
+            building = self._building.get(key)
+            if building is None:
+                self.misses += 1
+                future = self._building[key] = Future()
+            else:
+                self.hits += 1
+        if building is not None:
+            return building.result()
+
+        try:
+            from .moa import MOAgent
+            if isinstance(config, MOAgentConfig):
+                config = config.model_dump(exclude_unset=True)
+            pipeline = MOAgent.from_config(**config)
+        except BaseException as e:
+            with self._lock:
+                del self._building[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._pipelines[key] = pipeline
+            while len(self._pipelines) > self.maxsize:
+                self._pipelines.popitem(last=False)
+            del self._building[key]
+        future.set_result(pipeline)
+        return pipeline
+
+    def get(self, config: MOAgentConfig | Dict[str, Any], conversation_id: Optional[str] = None) -> "MOAgent":
+        """A new conversation handle for ``config``.
+
+        With ``conversation_id`` the conversation is loaded from and saved to the
+        configured ``state_store`` instead of living in this process.
+        """
+        if conversation_id is not None:
+            return self.compiled(config).conversation(conversation_id)
+        return self.compiled(config).spawn()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pipelines.clear()
+
+    def __len__(self) -> int:
+        return len(self._pipelines)
+
+
+_default_registry: Optional[AgentRegistry] = None
+
+
+def get_registry() -> AgentRegistry:
+    """Process-wide registry, shared by every Streamlit session and server worker."""
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = AgentRegistry()
+    return _default_registry
@@ -0,0 +1,284 @@
+"""
+Record and replay of model traffic for offline profiling and load tests
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import threading
+import time
+from contextlib import aclosing, closing
+from typing import Any, AsyncIterator, Dict, Iterator, List, Literal, Optional, Tuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+# Client settings that don't change what a model answers, left out of the recorded params
+TRANSPORT_KWARGS = ('max_retries', 'timeout', 'request_timeout', 'http_client', 'http_async_client', 'base_url', 'api_key', 'groq_api_key')
+
+
+def traffic_params(model_name: str, llm_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    return {'model': model_name, **{k: v for k, v in llm_kwargs.items() if k not in TRANSPORT_KWARGS}}
+
+
+def prompt_hash(messages: List[BaseMessage]) -> str:
+    payload = json.dumps([[m.type, m.content] for m in messages], default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def params_hash(params: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class TrafficRecorder:
+    """Appends one JSON line per model call to ``path``.
+
+    Each record holds the model, its sampling params, a hash of the prompt, the
+    streamed chunks as ``[seconds since the previous chunk, text]`` pairs, and the
+    error the call ended with, if any. Only hashes of prompts are stored.
+    """
+
+    def __init__(self, path: str = "moa_traffic.jsonl") -> None:
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, separators=(',', ':'), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def recorder_from_config(spec: Optional[TrafficRecorder | str]) -> Optional[TrafficRecorder]:
+    """Resolve a ``record_traffic`` config value: a recorder or the path of the trace file."""
+    if spec is None or isinstance(spec, TrafficRecorder):
+        return spec
+    return TrafficRecorder(spec)
+
+
+class CallRecord:
+    """Timing of one call in progress."""
+
+    def __init__(self, params: Dict[str, Any], prompt: PromptValue, stream: bool) -> None:
+        self.record: Dict[str, Any] = {
+            'time': time.time(),
+            'model': params['model'],
+            'params': params,
+            'prompt': prompt_hash(prompt.to_messages()),
+            'stream': stream,
+            'chunks': []
+        }
+        self.start = self.last = time.monotonic()
+
+    def chunk(self, text: str) -> None:
+        now = time.monotonic()
+        self.record['chunks'].append([round(now - self.last, 4), text])
+        self.last = now
+
+    def finish(self, error: Optional[BaseException] = None, cancelled: bool = False) -> Dict[str, Any]:
+        self.record['duration'] = round(time.monotonic() - self.start, 4)
+        if error is not None:
+            self.record['error'] = {
+                'type': type(error).__name__,
+                'message': str(error),
+                'status_code': getattr(error, 'status_code', None)
+            }
+        if cancelled:
+            self.record['cancelled'] = True
+        return self.record
+
+
+class RecordingRunnable(Runnable[PromptValue, str]):
+    """Wraps an ``llm | StrOutputParser()`` runnable, recording every call to a ``TrafficRecorder``."""
+
+    def __init__(self, bound: Runnable[PromptValue, str], recorder: TrafficRecorder, params: Dict[str, Any]) -> None:
+        self.bound = bound
+        self.recorder = recorder
+        self.params = params
+
+    def invoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        call = CallRecord(self.params, input, stream=False)
+        try:
+            output = self.bound.invoke(input, config, **kwargs)
+        except Exception as e:
+            self.recorder.write(call.finish(e))
+            raise
+        call.chunk(output)
+        self.recorder.write(call.finish())
+        return output
+
+    async def ainvoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        call = CallRecord(self.params, input, stream=False)
+        try:
+            output = await self.bound.ainvoke(input, config, **kwargs)
+        except asyncio.CancelledError:
+            self.recorder.write(call.finish(cancelled=True))
+            raise
+        except Exception as e:
+            self.recorder.write(call.finish(e))
+            raise
+        call.chunk(output)
+        self.recorder.write(call.finish())
+        return output
+
+    def stream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[str]:
+        call = CallRecord(self.params, input, stream=True)
+        try:
+            with closing(self.bound.stream(input, config, **kwargs)) as stream:
+                for chunk in stream:
+                    call.chunk(chunk)
+                    yield chunk
+        except GeneratorExit:
+            self.recorder.write(call.finish(cancelled=True))
+            raise
+        except Exception as e:
+            self.recorder.write(call.finish(e))
+            raise
+        self.recorder.write(call.finish())
+
+    async def astream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[str]:
+        call = CallRecord(self.params, input, stream=True)
+        try:
+            async with aclosing(self.bound.astream(input, config, **kwargs)) as stream:
+                async for chunk in stream:
+                    call.chunk(chunk)
+                    yield chunk
+        except (GeneratorExit, asyncio.CancelledError):
+            self.recorder.write(call.finish(cancelled=True))
+            raise
+        except Exception as e:
+            self.recorder.write(call.finish(e))
+            raise
+        self.recorder.write(call.finish())
+
+
+class ReplayMiss(LookupError):
+    """Raised when a replayed call has no recorded counterpart."""
+
+
+class ReplayedError(Exception):
+    """Error a recorded call ended with, carrying its original ``status_code`` so retries behave alike."""
+
+    def __init__(self, error: Dict[str, Any]) -> None:
+        super().__init__(f"{error['type']}: {error['message']}")
+        self.status_code = error.get('status_code')
+
+
+class TrafficLog:
+    """Recorded calls indexed by model, params and prompt.
+
+    Repeated identical calls are answered by their recordings in turn. With
+    ``on_miss='model'``, a call that wasn't recorded is answered by the next
+    recording of the same model, which keeps real latencies and answer lengths
+    when load testing with new prompts.
+    """
+
+    def __init__(self, path: str, on_miss: Literal['error', 'model'] = 'error') -> None:
+        self.on_miss = on_miss
+        self._calls: Dict[Tuple[str, str, str], List[Dict[str, Any]]] = {}
+        self._by_model: Dict[str, List[Dict[str, Any]]] = {}
+        self._turns: Dict[Any, Iterator[int]] = {}
+        self._lock = threading.Lock()
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Partially written line from a crash
+                if record.get('cancelled'):
+                    continue  # Cut short by its caller, so its timing says little
+                key = (record['model'], params_hash(record['params']), record['prompt'])
+                self._calls.setdefault(key, []).append(record)
+                self._by_model.setdefault(record['model'], []).append(record)
+
+    def __len__(self) -> int:
+        return sum(len(records) for records in self._calls.values())
+
+    def _next(self, key: Any, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        with self._lock:
+            turn = self._turns.setdefault(key, itertools.count())
+            return records[next(turn) % len(records)]
+
+    def lookup(self, params: Dict[str, Any], messages: List[BaseMessage]) -> Dict[str, Any]:
+        key = (params['model'], params_hash(params), prompt_hash(messages))
+        if key in self._calls:
+            return self._next(key, self._calls[key])
+        if self.on_miss == 'model' and params['model'] in self._by_model:
+            return self._next(params['model'], self._by_model[params['model']])
+        raise ReplayMiss(f"No recorded call to {params['model']} for this prompt")
+
+
+class ReplayChatModel(BaseChatModel):
+    """Chat model answering from a ``TrafficLog`` with the recorded chunks and timing.
+
+    Delays are multiplied by ``time_scale``: 1 reproduces the recorded timing,
+    0.5 replays twice as fast and 0 without any delay.
+    """
+    model_name: str
+    params: Dict[str, Any]
+    log: Any
+    time_scale: float = 1.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "moa-replay"
+
+    def _delays(self, record: Dict[str, Any]) -> Iterator[Tuple[float, str]]:
+        for delay, text in record['chunks']:
+            yield delay * self.time_scale, text
+
+    def _error_delay(self, record: Dict[str, Any]) -> float:
+        return max(0.0, record['duration'] - sum(delay for delay, _ in record['chunks'])) * self.time_scale
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        record = self.log.lookup(self.params, messages)
+        for delay, text in self._delays(record):
+            time.sleep(delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+        if record.get('error'):
+            time.sleep(self._error_delay(record))
+            raise ReplayedError(record['error'])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        record = self.log.lookup(self.params, messages)
+        for delay, text in self._delays(record):
+            await asyncio.sleep(delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+        if record.get('error'):
+            await asyncio.sleep(self._error_delay(record))
+            raise ReplayedError(record['error'])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        content = "".join(chunk.message.content for chunk in self._stream(messages, stop, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        content = "".join([chunk.message.content async for chunk in self._astream(messages, stop, **kwargs)])
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+
+def replay_chat_model_factory(
+    path: str,
+    time_scale: float = 1.0,
+    on_miss: Literal['error', 'model'] = 'error'
+):
+    """Factory for ``set_chat_model_factory`` replaying the traffic recorded in ``path``."""
+    log = TrafficLog(path, on_miss=on_miss)
+
+    def factory(model: str, **llm_kwargs: Any) -> ReplayChatModel:
+        return ReplayChatModel(
+            model_name=model,
+            params=traffic_params(model, llm_kwargs),
+            log=log,
+            time_scale=time_scale
+        )
+
+    return factory
@@ -0,0 +1,242 @@
+"""
+Per-query routing of layer agents driven by learned cost and latency profiles
+"""
+import re
+import threading
+from typing import Any, Dict, List, Literal, Optional, Union
+
+from pydantic import BaseModel, Field
+from langchain_core.runnables import Runnable
+
+from .convergence import WORD_PATTERN
+from .instrumentation import MetricsSink
+
+Difficulty = Literal['simple', 'moderate', 'hard']
+
+# USD per million (prompt, completion) tokens on Groq
+MODEL_PRICES = {
+    'llama3-70b-8192': (0.59, 0.79),
+    'llama3-8b-8192': (0.05, 0.08),
+    'gemma-7b-it': (0.07, 0.07),
+    'gemma2-9b-it': (0.20, 0.20),
+    'mixtral-8x7b-32768': (0.24, 0.24),
+    'llama-3.1-8b-instant': (0.05, 0.08),
+    'llama-3.1-70b-versatile': (0.59, 0.79),
+}
+DEFAULT_PRICE = (0.59, 0.79)
+# Token counts assumed for an agent that has no recorded calls yet
+PRIOR_PROMPT_TOKENS = 500
+PRIOR_COMPLETION_TOKENS = 300
+
+CHITCHAT_PATTERN = re.compile(
+    r"^\s*(hi|hello|hey|yo|thanks|thank you|thx|ok|okay|cool|bye|good (morning|afternoon|evening|night)"
+    r"|how are you|what'?s up|who are you)\b",
+    re.IGNORECASE
+)
+CODE_PATTERN = re.compile(r"```|\bdef |\bclass |\bfunction\b|\bimport |[{};]\s*$|=>", re.MULTILINE)
+MATH_PATTERN = re.compile(r"\d\s*[-+*/^=<>]\s*\d|\\frac|\\sum|\bintegral\b|\bequation\b|\bprobability\b", re.IGNORECASE)
+HARD_MARKERS = (
+    'prove', 'derive', 'step by step', 'analy', 'compare', 'trade-off', 'tradeoff', 'design',
+    'implement', 'optimi', 'debug', 'algorithm', 'architecture', 'evaluate', 'pros and cons'
+)
+MODERATE_MARKERS = ('explain', 'why', 'how do', 'how does', 'describe', 'summar', 'write', 'difference')
+
+
+def classify_query(query: str) -> Difficulty:
+    """Cheap lexical estimate of how hard ``query`` is to answer."""
+    words = len(WORD_PATTERN.findall(query))
+    if CHITCHAT_PATTERN.match(query) and words <= 8:
+        return 'simple'
+
+    lowered = query.lower()
+    score = 0
+    score += words > 40
+    score += words > 150
+    score += bool(CODE_PATTERN.search(query))
+    score += bool(MATH_PATTERN.search(query))
+    score += min(2, sum(marker in lowered for marker in HARD_MARKERS))
+    score += query.count('?') > 1
+    if score >= 2:
+        return 'hard'
+    if score == 1 or words > 12 or any(marker in lowered for marker in MODERATE_MARKERS):
+        return 'moderate'
+    return 'simple'
+
+
+class AgentProfile(BaseModel):
+    """Exponentially weighted averages of one agent's recent calls."""
+    model: Optional[str] = None
+    calls: int = 0
+    duration: float = 0.0
+    prompt_tokens: float = 0.0
+    completion_tokens: float = 0.0
+
+
+class AgentProfiles(MetricsSink):
+    """Learns per-agent latency and token usage from the ``llm`` spans of finished traces."""
+
+    def __init__(self, alpha: float = 0.2) -> None:
+        self.alpha = alpha
+        self.profiles: Dict[str, AgentProfile] = {}
+        self._lock = threading.Lock()
+
+    def export(self, trace: Dict[str, Any]) -> None:
+        with self._lock:
+            for span in trace['spans']:
+                if span['name'] != 'llm' or 'agent' not in span:
+                    continue
+                if span.get('cancelled'):
+                    # A call cut off by a deadline or quorum only tells how long it was allowed to run
+                    continue
+                if span.get('cache_hit'):
+                    # Answered without calling the model, so its timing says nothing about the agent
+                    continue
+                profile = self.profiles.setdefault(span['agent'], AgentProfile(model=span.get('model')))
+                # Plain averages until there is enough data for the moving average to be stable
+                alpha = max(self.alpha, 1.0 / (profile.calls + 1))
+                profile.calls += 1
+                profile.duration += alpha * (span['duration'] - profile.duration)
+                profile.prompt_tokens += alpha * (span.get('prompt_tokens', 0) - profile.prompt_tokens)
+                profile.completion_tokens += alpha * (span.get('completion_tokens', 0) - profile.completion_tokens)
+
+    def get(self, agent: str) -> Optional[AgentProfile]:
+        with self._lock:
+            profile = self.profiles.get(agent)
+            return profile.model_copy() if profile is not None else None
+
+
+class RouteTier(BaseModel):
+    """What runs for queries of one difficulty.
+
+    ``agents`` is how many of the cheapest layer agents to run (all when ``None``)
+    and ``cycles`` caps the configured cycles. With ``direct`` the cheapest agent
+    answers on its own, skipping the layer and the main agent.
+    """
+    agents: Optional[int] = None
+    cycles: Optional[int] = None
+    direct: bool = False
+
+
+class RoutingPolicy(BaseModel):
+    """Per-difficulty tiers and how agents are ranked.
+
+    Agents are ranked by expected cost and latency, normalized across the
+    candidates and mixed by ``latency_weight``. Profiles with fewer than
+    ``min_calls`` calls fall back to list prices and prior token counts.
+    ``classifier_model`` replaces the lexical classifier by a small model.
+    """
+    simple: RouteTier = Field(default_factory=lambda: RouteTier(agents=1, cycles=1, direct=True))
+    moderate: RouteTier = Field(default_factory=lambda: RouteTier(agents=2, cycles=1))
+    hard: RouteTier = Field(default_factory=RouteTier)
+    latency_weight: float = 0.5
+    min_calls: int = 3
+    classifier_model: Optional[str] = None
+
+    @classmethod
+    def from_config(cls, spec: Optional[Union["RoutingPolicy", Dict[str, Any], bool]]) -> Optional["RoutingPolicy"]:
+        if spec is None or spec is False:
+            return None
+        if spec is True:
+            return cls()
+        if isinstance(spec, cls):
+            return spec
+        return cls.model_validate(spec)
+
+
+class Route(BaseModel):
+    difficulty: Difficulty
+    agents: List[str]
+    cycles: int
+    direct: Optional[str] = None
+
+
+class Router:
+    """Picks the layer agents and cycles for each query.
+
+    ``agent_models`` maps layer agent names to their model, used to price agents
+    without a learned profile. Add ``profiles`` to the agent's sinks so it keeps
+    learning from every turn.
+    """
+
+    def __init__(
+        self,
+        agent_models: Dict[str, str],
+        policy: Optional[RoutingPolicy] = None,
+        profiles: Optional[AgentProfiles] = None,
+        classifier: Optional[Runnable[Dict[str, str], str]] = None
+    ) -> None:
+        self.agent_models = agent_models
+        self.policy = policy or RoutingPolicy()
+        self.profiles = profiles or AgentProfiles()
+        self.classifier = classifier
+
+    def expected_cost(self, agent: str) -> float:
+        profile = self.profiles.get(agent)
+        model = self.agent_models.get(agent) or (profile.model if profile else None)
+        prompt_price, completion_price = MODEL_PRICES.get(model, DEFAULT_PRICE)
+        if profile is not None and profile.calls >= self.policy.min_calls:
+            prompt_tokens, completion_tokens = profile.prompt_tokens, profile.completion_tokens
+        else:
+            prompt_tokens, completion_tokens = PRIOR_PROMPT_TOKENS, PRIOR_COMPLETION_TOKENS
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+    def expected_latency(self, agent: str) -> Optional[float]:
+        profile = self.profiles.get(agent)
+        if profile is None or profile.calls < self.policy.min_calls:
+            return None
+        return profile.duration
+
+    def rank(self, agents: List[str]) -> List[str]:
+        """``agents`` from cheapest and fastest to most expensive and slowest."""
+        costs = {a: self.expected_cost(a) for a in agents}
+        latencies = {a: self.expected_latency(a) for a in agents}
+        known = [l for l in latencies.values() if l is not None]
+        # Agents without timings yet are assumed average so they still get tried
+        default_latency = sum(known) / len(known) if known else 0.0
+        latencies = {a: default_latency if l is None else l for a, l in latencies.items()}
+        max_cost = max(costs.values(), default=0.0) or 1.0
+        max_latency = max(latencies.values(), default=0.0) or 1.0
+        weight = self.policy.latency_weight
+
+        def score(agent: str) -> float:
+            return (1 - weight) * costs[agent] / max_cost + weight * latencies[agent] / max_latency
+
+        return sorted(agents, key=score)
+
+    @staticmethod
+    def _parse(label: str) -> Optional[Difficulty]:
+        words = WORD_PATTERN.findall(label.lower())
+        for word in words:
+            if word in ('simple', 'moderate', 'hard'):
+                return word
+        return None
+
+    def _plan(self, difficulty: Difficulty, cycles: int) -> Route:
+        tier: RouteTier = getattr(self.policy, difficulty)
+        ranked = self.rank(list(self.agent_models))
+        agents = ranked[:tier.agents] if tier.agents else ranked
+        if tier.direct and agents:
+            return Route(difficulty=difficulty, agents=[], cycles=0, direct=agents[0])
+        return Route(
+            difficulty=difficulty,
+            agents=agents,
+            cycles=min(cycles, tier.cycles) if tier.cycles else cycles
+        )
+
+    def route(self, query: str, cycles: int) -> Route:
+        difficulty = None
+        if self.classifier is not None:
+            try:
+                difficulty = self._parse(self.classifier.invoke({'input': query}))
+            except Exception:
+                pass  # Fall back to the lexical classifier
+        return self._plan(difficulty or classify_query(query), cycles)
+
+    async def aroute(self, query: str, cycles: int) -> Route:
+        difficulty = None
+        if self.classifier is not None:
+            try:
+                difficulty = self._parse(await self.classifier.ainvoke({'input': query}))
+            except Exception:
+                pass
+        return self._plan(difficulty or classify_query(query), cycles)
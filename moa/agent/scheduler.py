@@ -0,0 +1,300 @@
+"""
+Client-side rate limiting and retries for model calls
+"""
+import asyncio
+import random
+import threading
+import time
+from contextlib import aclosing, closing
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+from pydantic import BaseModel
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from .instrumentation import record_event
+from .memory import DEFAULT_COMPLETION_RESERVE, count_message_tokens
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request is shed instead of queued."""
+
+
+class RateLimit(BaseModel):
+    """Budget for one model. Unset fields are not enforced."""
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    # Shed new requests once this many are already waiting, or if they would wait longer than max_wait
+    max_queue_depth: Optional[int] = None
+    max_wait: Optional[float] = None
+
+
+class RetryPolicy(BaseModel):
+    max_retries: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 20.0
+
+    def delay(self, attempt: int, error: Exception) -> float:
+        """Full-jitter exponential backoff, honouring a ``Retry-After`` header when present."""
+        response = getattr(error, 'response', None)
+        retry_after = getattr(response, 'headers', {}).get('retry-after') if response is not None else None
+        try:
+            return min(float(retry_after), self.max_delay)
+        except (TypeError, ValueError):
+            return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def is_retryable(error: Exception) -> bool:
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    # Connection errors and timeouts from the groq SDK and httpx carry no status code
+    return type(error).__name__ in {'APIConnectionError', 'APITimeoutError', 'ConnectError', 'ReadTimeout'}
+
+
+class TokenBucket:
+    """Bucket refilled continuously at ``capacity`` per minute.
+
+    Reservations may drive the level negative; the deficit tells each caller how
+    long to wait, which serves concurrent callers in arrival order.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def wait_time(self, amount: float, now: float) -> float:
+        level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        return max(0.0, (amount - level) / self.rate)
+
+
+class ModelStats(BaseModel):
+    requests: int = 0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+    shed: int = 0
+    retries: int = 0
+
+    @property
+    def mean_wait(self) -> float:
+        return self.total_wait / self.requests if self.requests else 0.0
+
+
+class ModelScheduler:
+    """Enforces per-model request and token budgets shared by every agent in the process."""
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, RateLimit | Dict[str, Any]]] = None,
+        retry: Optional[RetryPolicy] = None
+    ) -> None:
+        self.limits = {model: RateLimit.model_validate(limit) for model, limit in (limits or {}).items()}
+        self.retry = retry or RetryPolicy()
+        self._buckets: Dict[str, Dict[str, TokenBucket]] = {}
+        self._stats: Dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+
+    def set_limit(self, model: str, limit: RateLimit | Dict[str, Any]) -> None:
+        with self._lock:
+            self.limits[model] = RateLimit.model_validate(limit)
+            self._buckets.pop(model, None)
+
+    def _reserve(self, model: str, tokens: int) -> float:
+        """Reserve capacity for one request and return how long the caller must wait."""
+        with self._lock:
+            stats = self._stats.setdefault(model, ModelStats())
+            limit = self.limits.get(model)
+            if limit is None:
+                stats.requests += 1
+                return 0.0
+
+            buckets = self._buckets.setdefault(model, {})
+            if limit.requests_per_minute and 'requests' not in buckets:
+                buckets['requests'] = TokenBucket(limit.requests_per_minute)
+            if limit.tokens_per_minute and 'tokens' not in buckets:
+                buckets['tokens'] = TokenBucket(limit.tokens_per_minute)
+            amounts = {'requests': 1, 'tokens': min(tokens, limit.tokens_per_minute or tokens)}
+
+            now = time.monotonic()
+            expected = max((b.wait_time(amounts[k], now) for k, b in buckets.items()), default=0.0)
+            if (
+                (limit.max_queue_depth is not None and expected > 0 and stats.queue_depth >= limit.max_queue_depth)
+                or (limit.max_wait is not None and expected > limit.max_wait)
+            ):
+                stats.shed += 1
+                raise RateLimitExceeded(f"Rate limit queue for {model} is full")
+
+            wait = max((b.reserve(amounts[k], now) for k, b in buckets.items()), default=0.0)
+            stats.requests += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            if wait > 0:
+                stats.queue_depth += 1
+                stats.max_queue_depth = max(stats.max_queue_depth, stats.queue_depth)
+            return wait
+
+    def _release(self, model: str, wait: float) -> None:
+        if wait > 0:
+            with self._lock:
+                self._stats[model].queue_depth -= 1
+
+    def acquire(self, model: str, tokens: int = 0) -> float:
+        wait = self._reserve(model, tokens)
+        try:
+            time.sleep(wait)
+        finally:
+            self._release(model, wait)
+        return wait
+
+    async def aacquire(self, model: str, tokens: int = 0) -> float:
+        wait = self._reserve(model, tokens)
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            self._release(model, wait)
+        return wait
+
+    def record_retry(self, model: str) -> None:
+        with self._lock:
+            self._stats.setdefault(model, ModelStats()).retries += 1
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Queue depth, wait times, shed and retry counts per model."""
+        with self._lock:
+            return {
+                model: {**stats.model_dump(), 'mean_wait': stats.mean_wait}
+                for model, stats in self._stats.items()
+            }
+
+
+_default_scheduler: Optional[ModelScheduler] = None
+
+
+def get_default_scheduler() -> ModelScheduler:
+    """Process-wide scheduler used by agents unless another one is passed to ``MOAgent.from_config``."""
+    global _default_scheduler
+    if _default_scheduler is None:
+        _default_scheduler = ModelScheduler()
+    return _default_scheduler
+
+
+def configure_rate_limits(limits: Dict[str, RateLimit | Dict[str, Any]]) -> ModelScheduler:
+    scheduler = get_default_scheduler()
+    for model, limit in limits.items():
+        scheduler.set_limit(model, limit)
+    return scheduler
+
+
+class ScheduledRunnable(Runnable[PromptValue, str]):
+    """Wraps an ``llm | StrOutputParser()`` runnable with rate limiting and retries.
+
+    The token reservation is the estimated prompt size plus ``max_tokens``. Streams
+    are only retried if they fail before their first chunk. ``max_retries``
+    overrides the scheduler's retry policy for this model.
+    """
+
+    def __init__(
+        self,
+        bound: Runnable[PromptValue, str],
+        scheduler: ModelScheduler,
+        model_name: str,
+        max_tokens: Optional[int] = None,
+        max_retries: Optional[int] = None
+    ) -> None:
+        self.bound = bound
+        self.scheduler = scheduler
+        self.model_name = model_name
+        self.max_tokens = max_tokens or DEFAULT_COMPLETION_RESERVE
+        self.max_retries = scheduler.retry.max_retries if max_retries is None else max_retries
+
+    def _tokens(self, input: PromptValue) -> int:
+        return count_message_tokens(input.to_messages()) + self.max_tokens
+
+    def _waited(self, config: Optional[RunnableConfig], wait: float) -> None:
+        if wait > 0:
+            record_event(config, 'rate_limit_wait', model=self.model_name, wait=wait)
+
+    def _retry(self, attempt: int, error: Exception, config: Optional[RunnableConfig]) -> Optional[float]:
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        self.scheduler.record_retry(self.model_name)
+        record_event(config, 'retry', model=self.model_name, attempt=attempt + 1, error=type(error).__name__)
+        return self.scheduler.retry.delay(attempt, error)
+
+    def invoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        tokens = self._tokens(input)
+        attempt = 0
+        while True:
+            self._waited(config, self.scheduler.acquire(self.model_name, tokens))
+            try:
+                return self.bound.invoke(input, config, **kwargs)
+            except Exception as e:
+                delay = self._retry(attempt, e, config)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    async def ainvoke(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        tokens = self._tokens(input)
+        attempt = 0
+        while True:
+            self._waited(config, await self.scheduler.aacquire(self.model_name, tokens))
+            try:
+                return await self.bound.ainvoke(input, config, **kwargs)
+            except Exception as e:
+                delay = self._retry(attempt, e, config)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def stream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[str]:
+        tokens = self._tokens(input)
+        attempt = 0
+        while True:
+            self._waited(config, self.scheduler.acquire(self.model_name, tokens))
+            started = False
+            try:
+                with closing(self.bound.stream(input, config, **kwargs)) as stream:
+                    for chunk in stream:
+                        started = True
+                        yield chunk
+                return
+            except Exception as e:
+                delay = None if started else self._retry(attempt, e, config)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    async def astream(self, input: PromptValue, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[str]:
+        tokens = self._tokens(input)
+        attempt = 0
+        while True:
+            self._waited(config, await self.scheduler.aacquire(self.model_name, tokens))
+            started = False
+            try:
+                async with aclosing(self.bound.astream(input, config, **kwargs)) as stream:
+                    async for chunk in stream:
+                        started = True
+                        yield chunk
+                return
+            except Exception as e:
+                delay = None if started else self._retry(attempt, e, config)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
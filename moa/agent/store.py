@@ -0,0 +1,281 @@
+"""
+Conversation state stores, so any worker can serve any turn of a conversation
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable
+
+from .memory import DEFAULT_CONTEXT_WINDOW, BoundedConversationMemory
+
+MESSAGE_TYPES = {'human': 'h', 'ai': 'a', 'system': 's'}
+MESSAGE_CLASSES = {'h': HumanMessage, 'a': AIMessage, 's': SystemMessage}
+
+
+def dumps_message(message: BaseMessage) -> str:
+    """Compact ``["h", "content"]`` encoding of a message."""
+    return json.dumps([MESSAGE_TYPES[message.type], message.content], separators=(',', ':'), ensure_ascii=False)
+
+
+def loads_message(data: str) -> BaseMessage:
+    kind, content = json.loads(data)
+    return MESSAGE_CLASSES[kind](content=content)
+
+
+class Checkpoint(BaseModel):
+    """Where a conversation's live window starts, and the summary of everything before it."""
+    start: int = 0
+    summary: str = ""
+
+
+class ConversationStore(ABC):
+    """Append-only message log per conversation plus a small checkpoint record.
+
+    Messages are never rewritten: they get consecutive sequence numbers from 0
+    and readers fetch only the ones past what they already hold. This maps onto
+    a networked key-value store as a list per conversation and one key for the
+    checkpoint. The async methods run the sync ones in a worker thread unless a
+    backend overrides them.
+    """
+
+    @abstractmethod
+    def append(self, conversation_id: str, messages: List[BaseMessage]) -> int:
+        """Append ``messages`` and return the conversation's new length."""
+
+    @abstractmethod
+    def read(self, conversation_id: str, start: int = 0) -> List[BaseMessage]:
+        """Messages from sequence number ``start`` on."""
+
+    @abstractmethod
+    def get_checkpoint(self, conversation_id: str) -> Checkpoint:
+        ...
+
+    @abstractmethod
+    def set_checkpoint(self, conversation_id: str, checkpoint: Checkpoint) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, conversation_id: str) -> None:
+        ...
+
+    async def aappend(self, conversation_id: str, messages: List[BaseMessage]) -> int:
+        return await asyncio.to_thread(self.append, conversation_id, messages)
+
+    async def aread(self, conversation_id: str, start: int = 0) -> List[BaseMessage]:
+        return await asyncio.to_thread(self.read, conversation_id, start)
+
+    async def aget_checkpoint(self, conversation_id: str) -> Checkpoint:
+        return await asyncio.to_thread(self.get_checkpoint, conversation_id)
+
+    async def aset_checkpoint(self, conversation_id: str, checkpoint: Checkpoint) -> None:
+        await asyncio.to_thread(self.set_checkpoint, conversation_id, checkpoint)
+
+
+class InMemoryStore(ConversationStore):
+    """Process-local store, for development and single-worker deployments."""
+
+    def __init__(self) -> None:
+        self._messages: Dict[str, List[str]] = {}
+        self._checkpoints: Dict[str, Checkpoint] = {}
+        self._lock = threading.Lock()
+
+    def append(self, conversation_id: str, messages: List[BaseMessage]) -> int:
+        with self._lock:
+            log = self._messages.setdefault(conversation_id, [])
+            log.extend(dumps_message(m) for m in messages)
+            return len(log)
+
+    def read(self, conversation_id: str, start: int = 0) -> List[BaseMessage]:
+        with self._lock:
+            return [loads_message(m) for m in self._messages.get(conversation_id, [])[start:]]
+
+    def get_checkpoint(self, conversation_id: str) -> Checkpoint:
+        with self._lock:
+            return self._checkpoints.get(conversation_id, Checkpoint()).model_copy()
+
+    def set_checkpoint(self, conversation_id: str, checkpoint: Checkpoint) -> None:
+        with self._lock:
+            self._checkpoints[conversation_id] = checkpoint.model_copy()
+
+    def delete(self, conversation_id: str) -> None:
+        with self._lock:
+            self._messages.pop(conversation_id, None)
+            self._checkpoints.pop(conversation_id, None)
+
+
+class SQLiteStore(ConversationStore):
+    """Embedded store in a SQLite file, shareable by the worker processes of one host."""
+
+    def __init__(self, path: str = "moa_conversations.db") -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # WAL lets readers in other processes proceed while a turn is written
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, data TEXT NOT NULL, "
+            "PRIMARY KEY (conversation_id, seq)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "conversation_id TEXT PRIMARY KEY, start INTEGER NOT NULL, summary TEXT NOT NULL)"
+        )
+
+    def append(self, conversation_id: str, messages: List[BaseMessage]) -> int:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                (length,) = self._conn.execute(
+                    "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE conversation_id = ?",
+                    (conversation_id,)
+                ).fetchone()
+                self._conn.executemany(
+                    "INSERT INTO messages (conversation_id, seq, data) VALUES (?, ?, ?)",
+                    [(conversation_id, length + i, dumps_message(m)) for i, m in enumerate(messages)]
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return length + len(messages)
+
+    def read(self, conversation_id: str, start: int = 0) -> List[BaseMessage]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM messages WHERE conversation_id = ? AND seq >= ? ORDER BY seq",
+                (conversation_id, start)
+            ).fetchall()
+        return [loads_message(data) for (data,) in rows]
+
+    def get_checkpoint(self, conversation_id: str) -> Checkpoint:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT start, summary FROM checkpoints WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+        return Checkpoint(start=row[0], summary=row[1]) if row else Checkpoint()
+
+    def set_checkpoint(self, conversation_id: str, checkpoint: Checkpoint) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (conversation_id, start, summary) VALUES (?, ?, ?)",
+                (conversation_id, checkpoint.start, checkpoint.summary)
+            )
+
+    def delete(self, conversation_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            self._conn.execute("DELETE FROM checkpoints WHERE conversation_id = ?", (conversation_id,))
+
+
+def store_from_config(spec: Optional[ConversationStore | Dict[str, Any]]) -> Optional[ConversationStore]:
+    """Resolve a ``state_store`` config value, e.g. ``{"backend": "sqlite", "path": "moa_conversations.db"}``."""
+    if spec is None:
+        return None
+    if isinstance(spec, ConversationStore):
+        return spec
+
+    spec = dict(spec)
+    backend = spec.pop("backend", "sqlite")
+    if backend == "memory":
+        return InMemoryStore(**spec)
+    if backend == "sqlite":
+        return SQLiteStore(**spec)
+    raise ValueError(f"Unknown state store backend: {backend}")
+
+
+class StoredConversationMemory(BoundedConversationMemory):
+    """``BoundedConversationMemory`` persisted in a ``ConversationStore``.
+
+    Only the live window is held in memory. Each load fetches the messages
+    appended since the last one (possibly by another worker), and each save
+    appends the new turn. Evicting old turns only moves the stored checkpoint
+    forward. Turns of one conversation are assumed to be saved one at a time.
+    """
+
+    def __init__(
+        self,
+        store: ConversationStore,
+        conversation_id: str,
+        max_token_limit: int = DEFAULT_CONTEXT_WINDOW,
+        summarizer: Optional[Runnable[Dict[str, str], str]] = None,
+        memory_key: str = "messages"
+    ) -> None:
+        super().__init__(max_token_limit=max_token_limit, summarizer=summarizer, memory_key=memory_key)
+        self.store = store
+        self.conversation_id = conversation_id
+        self._start = 0
+        self._end = 0
+
+    def _apply(self, checkpoint: Checkpoint, messages: List[BaseMessage], since: Optional[int]) -> None:
+        """Merge what was read from the store: new messages after ``since``, or a whole new window."""
+        if since is None:
+            self.messages, self._start = messages, checkpoint.start
+            self._end = checkpoint.start + len(messages)
+        else:
+            self.messages.extend(messages)
+            self._end += len(messages)
+        self.summary = checkpoint.summary
+
+    def _sync(self) -> None:
+        checkpoint = self.store.get_checkpoint(self.conversation_id)
+        if checkpoint.start != self._start or not self._end:
+            self._apply(checkpoint, self.store.read(self.conversation_id, checkpoint.start), None)
+        else:
+            self._apply(checkpoint, self.store.read(self.conversation_id, self._end), self._end)
+
+    async def _async(self) -> None:
+        checkpoint = await self.store.aget_checkpoint(self.conversation_id)
+        if checkpoint.start != self._start or not self._end:
+            self._apply(checkpoint, await self.store.aread(self.conversation_id, checkpoint.start), None)
+        else:
+            self._apply(checkpoint, await self.store.aread(self.conversation_id, self._end), self._end)
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, List[BaseMessage]]:
+        self._sync()
+        return super().load_memory_variables(inputs)
+
+    async def aload_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, List[BaseMessage]]:
+        await self._async()
+        return super().load_memory_variables(inputs)
+
+    def _turn(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> List[BaseMessage]:
+        return [HumanMessage(content=inputs['input']), AIMessage(content=outputs['output'])]
+
+    def _advance(self, previous_summary: str) -> Optional[Checkpoint]:
+        """The new checkpoint after a save, or ``None`` when nothing was evicted."""
+        start = self._end - len(self.messages)
+        if start == self._start and self.summary == previous_summary:
+            return None
+        self._start = start
+        return Checkpoint(start=start, summary=self.summary)
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        self._sync()
+        self._end = self.store.append(self.conversation_id, self._turn(inputs, outputs))
+        summary = self.summary
+        super().save_context(inputs, outputs)
+        # Most turns are a single append; only evictions rewrite the checkpoint
+        checkpoint = self._advance(summary)
+        if checkpoint is not None:
+            self.store.set_checkpoint(self.conversation_id, checkpoint)
+
+    async def asave_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        await self._async()
+        self._end = await self.store.aappend(self.conversation_id, self._turn(inputs, outputs))
+        summary = self.summary
+        await super().asave_context(inputs, outputs)
+        checkpoint = self._advance(summary)
+        if checkpoint is not None:
+            await self.store.aset_checkpoint(self.conversation_id, checkpoint)
+
+    def clear(self) -> None:
+        self.store.delete(self.conversation_id)
+        super().clear()
+        self._start = self._end = 0
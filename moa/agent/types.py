@@ -0,0 +1,50 @@
+"""
+Configuration and response types, importable without loading LangChain
+"""
+from typing import Any, Dict, List, Literal, Optional, TypedDict
+
+from pydantic import BaseModel, Field
+
+
+class MOAgentConfig(BaseModel):
+    main_model: Optional[str] = None
+    system_prompt: Optional[str] = None
+    cycles: int = Field(...)
+    layer_agent_config: Optional[Dict[str, Any]] = None
+    reference_system_prompt: Optional[str] = None
+    max_tokens: Optional[int] = None
+    layer_policy: Optional[Dict[str, Any]] = None
+    response_cache: Optional[bool | Dict[str, Any]] = None
+    history: Optional[int | Dict[str, Any]] = None
+    memory_max_tokens: Optional[int] = None
+    summary_model: Optional[str] = None
+    convergence: Optional[float | Dict[str, Any]] = None
+    compaction: Optional[Dict[str, Any]] = None
+    routing: Optional[bool | Dict[str, Any]] = None
+    state_store: Optional[Dict[str, Any]] = None
+    coalesce: Optional[bool] = None
+    fallbacks: Optional[List[str]] = None
+    hedge: Optional[bool | float | Dict[str, Any]] = None
+    circuit_breaker: Optional[Dict[str, Any]] = None
+    record_traffic: Optional[str] = None
+    layers: Optional[List[Dict[str, Any]]] = None
+
+    class Config:
+        extra = "allow"  # This allows for additional fields not explicitly defined
+
+
+valid_model_names = Literal[
+    'llama3-70b-8192',
+    'llama3-8b-8192',
+    'gemma-7b-it',
+    'gemma2-9b-it',
+    'mixtral-8x7b-32768',
+    'llama-3.1-8b-instant',
+    'llama-3.1-70b-versatile'
+]
+
+
+class ResponseChunk(TypedDict):
+    delta: str
+    response_type: Literal['intermediate', 'output']
+    metadata: Dict[str, Any]
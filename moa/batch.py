@@ -0,0 +1,165 @@
+"""
+Run MoA over a JSONL dataset with bounded concurrency
+
+Each input line is a JSON object with a ``prompt`` and optionally an ``id`` and
+prior ``messages`` (OpenAI-style ``role``/``content`` dicts). Results are
+appended to the output file as they complete, so an interrupted run resumes by
+skipping every id already written without an error.
+
+Usage:
+    python -m moa.batch prompts.jsonl results.jsonl --config moa_config.json --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from langchain_core.messages import convert_to_messages
+
+from moa.agent import MOAgent
+from moa.agent.cache import SQLiteCache
+from moa.agent.moa import MOAgentConfig
+from moa.agent.scheduler import configure_rate_limits
+
+
+def read_completed(path: str) -> Set[str]:
+    """Ids already answered successfully in an existing output file."""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Partially written line from a crash
+            if isinstance(record, dict) and 'id' in record and record.get('error') is None:
+                completed.add(str(record['id']))
+    return completed
+
+
+def read_prompts(path: str, skip: Set[str]) -> Iterator[Dict[str, Any]]:
+    """Pending input records; a line that isn't a JSON object is yielded with its error as ``invalid``."""
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("Input line is not a JSON object")
+            except ValueError as e:
+                record = {'invalid': e}
+            record['id'] = str(record.get('id', i))
+            if record['id'] not in skip:
+                yield record
+
+
+async def answer(agent: MOAgent, record: Dict[str, Any], intermediate: bool) -> Dict[str, Any]:
+    result: Dict[str, Any] = {'id': record['id'], 'prompt': record.get('prompt')}
+    layers: Dict[int, List[Dict[str, Any]]] = {}
+    output = ""
+    try:
+        # A bad record fails on its own rather than aborting the batch
+        if 'invalid' in record:
+            raise record['invalid']
+        if not isinstance(record.get('prompt'), str):
+            raise ValueError("Input record has no 'prompt' string")
+        async for chunk in agent.achat(
+            record['prompt'],
+            messages=convert_to_messages(record.get('messages') or []),
+            save=False,
+            output_format='json'
+        ):
+            metadata = chunk['metadata']
+            if chunk['response_type'] == 'intermediate':
+                layers.setdefault(metadata['layer'], []).append({
+                    'agent': metadata['agent'],
+                    'output': chunk['delta'],
+                    **({'cutoff': True} if metadata.get('cutoff') else {})
+                })
+            elif 'trace' in metadata:
+                result['usage'] = {
+                    k: metadata['trace'][k]
+                    for k in ('duration', 'prompt_tokens', 'completion_tokens', 'usage_estimated', 'cache_hits', 'retries')
+                }
+            else:
+                output += chunk['delta']
+        result['output'] = output
+        result['error'] = None
+    except Exception as e:
+        result['output'] = None
+        result['error'] = repr(e)
+    if intermediate:
+        result['layers'] = [layers[layer] for layer in sorted(layers)]
+    return result
+
+
+async def run_batch(
+    agent: MOAgent,
+    input_path: str,
+    output_path: str,
+    concurrency: int = 16,
+    intermediate: bool = True
+) -> Dict[str, int]:
+    """Answer every pending prompt with at most ``concurrency`` conversations in flight."""
+    prompts = read_prompts(input_path, skip=read_completed(output_path))
+    counts = {'completed': 0, 'failed': 0}
+
+    with open(output_path, 'a+') as out:
+        out.seek(0, os.SEEK_END)
+        if out.tell():
+            out.seek(out.tell() - 1)
+            if out.read(1) != "\n":
+                out.write("\n")  # Terminate a line cut short by a crash
+
+        async def worker() -> None:
+            # Workers pull from a shared iterator so memory stays flat however large the dataset is
+            for record in prompts:
+                result = await answer(agent, record, intermediate)
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+                counts['failed' if result['error'] else 'completed'] += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return counts
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, int]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help="JSONL file of prompts")
+    parser.add_argument('output', help="JSONL file results are appended to")
+    parser.add_argument('--config', help="MoA configuration JSON (MOAgentConfig fields)")
+    parser.add_argument('--concurrency', type=int, default=16, help="Conversations in flight at once")
+    parser.add_argument('--rate-limits', help="JSON file mapping model names to RateLimit fields")
+    parser.add_argument('--cache', help="SQLite file caching agent calls across runs (in-memory by default)")
+    parser.add_argument('--no-intermediate', action='store_true', help="Omit layer agent outputs from results")
+    args = parser.parse_args(argv)
+
+    config: Dict[str, Any] = {'cycles': 1}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    if args.rate_limits:
+        with open(args.rate_limits) as f:
+            configure_rate_limits(json.load(f))
+
+    agent_kwargs = MOAgentConfig(**config).model_dump(exclude_unset=True)
+    # Identical agent calls across the batch are answered from the cache
+    agent_kwargs.setdefault('response_cache', SQLiteCache(args.cache) if args.cache else True)
+    agent = MOAgent.from_config(**agent_kwargs)
+
+    counts = asyncio.run(run_batch(
+        agent,
+        args.input,
+        args.output,
+        concurrency=args.concurrency,
+        intermediate=not args.no_intermediate
+    ))
+    print(json.dumps(counts))
+    return counts
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Offline benchmark of MOAgent orchestration against a fake LLM backend
+
+Usage:
+    python -m moa.bench --scenario concurrent --requests 200 --concurrency 50
+    python -m moa.bench --replay moa_traffic.jsonl --time-scale 0.5
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from moa.agent import MOAgent
+from moa.agent.clients import set_chat_model_factory
+from moa.agent.fake import fake_chat_model_factory
+from moa.agent.instrumentation import percentile
+from moa.agent.moa import MOAgentConfig
+from moa.agent.replay import replay_chat_model_factory
+
+
+def peak_memory_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    ok = [r for r in results if r['error'] is None]
+    latencies = [r['latency'] for r in ok]
+    ttfts = [r['ttft'] for r in ok if r['ttft'] is not None]
+    return {
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'elapsed': elapsed,
+        'throughput': len(ok) / elapsed if elapsed else 0.0,
+        'latency': {f'p{q}': percentile(latencies, q) for q in (50, 95, 99)},
+        'ttft': {f'p{q}': percentile(ttfts, q) for q in (50, 95, 99)},
+        'peak_memory_mb': peak_memory_mb(),
+    }
+
+
+def build_agent(config: Dict[str, Any]) -> MOAgent:
+    return MOAgent.from_config(**MOAgentConfig(**config).model_dump(exclude_unset=True))
+
+
+def run_turn(agent: MOAgent, prompt: str, save: bool) -> Dict[str, Any]:
+    start, ttft = time.perf_counter(), None
+    try:
+        for chunk in agent.chat(prompt, save=save, output_format='json'):
+            if chunk['response_type'] == 'output' and chunk['delta'] and ttft is None:
+                ttft = time.perf_counter() - start
+        error = None
+    except Exception as e:
+        error = repr(e)
+    return {'latency': time.perf_counter() - start, 'ttft': ttft, 'error': error}
+
+
+async def arun_turn(agent: MOAgent, prompt: str, save: bool) -> Dict[str, Any]:
+    start, ttft = time.perf_counter(), None
+    try:
+        async for chunk in agent.achat(prompt, save=save, output_format='json'):
+            if chunk['response_type'] == 'output' and chunk['delta'] and ttft is None:
+                ttft = time.perf_counter() - start
+        error = None
+    except Exception as e:
+        error = repr(e)
+    return {'latency': time.perf_counter() - start, 'ttft': ttft, 'error': error}
+
+
+def bench_single(config: Dict[str, Any], requests: int) -> List[Dict[str, Any]]:
+    """Independent single-turn requests, one after another."""
+    agent = build_agent(config)
+    return [run_turn(agent, f"Question {i}?", save=False) for i in range(requests)]
+
+
+def bench_multi(config: Dict[str, Any], requests: int) -> List[Dict[str, Any]]:
+    """One conversation of ``requests`` turns, exercising memory replay."""
+    agent = build_agent(config)
+    return [run_turn(agent, f"Follow-up question {i}?", save=True) for i in range(requests)]
+
+
+async def bench_concurrent(config: Dict[str, Any], requests: int, concurrency: int) -> List[Dict[str, Any]]:
+    """Many single-turn conversations on one event loop, at most ``concurrency`` in flight."""
+    agent = build_agent(config)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> Dict[str, Any]:
+        async with semaphore:
+            return await arun_turn(agent, f"Question {i}?", save=False)
+
+    return await asyncio.gather(*(one(i) for i in range(requests)))
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=['single', 'multi', 'concurrent'], default='concurrent')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--config', help="MoA configuration JSON (MOAgentConfig fields)")
+    parser.add_argument('--cycles', type=int, default=None, help="Overrides the config's cycles")
+    parser.add_argument('--profiles', help="JSON file mapping model names to FakeModelProfile fields")
+    parser.add_argument('--ttft', type=float, default=0.2, help="Median time to first token in seconds")
+    parser.add_argument('--ttft-sigma', type=float, default=0.3)
+    parser.add_argument('--tokens-per-sec', type=float, default=500.0)
+    parser.add_argument('--output-tokens', type=int, default=64)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--replay', help="Traffic recorded with record_traffic, replayed instead of fake models")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="Multiplies replayed delays; 0 replays instantly")
+    args = parser.parse_args(argv)
+
+    config: Dict[str, Any] = {'cycles': 1}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    if args.cycles:
+        config['cycles'] = args.cycles
+
+    if args.replay:
+        # Benchmark prompts differ from the recorded ones, so each call replays a recording of its model
+        set_chat_model_factory(replay_chat_model_factory(args.replay, time_scale=args.time_scale, on_miss='model'))
+    else:
+        profiles = {}
+        if args.profiles:
+            with open(args.profiles) as f:
+                profiles = json.load(f)
+        set_chat_model_factory(fake_chat_model_factory(
+            profiles=profiles,
+            default={
+                'ttft': args.ttft,
+                'ttft_sigma': args.ttft_sigma,
+                'tokens_per_sec': args.tokens_per_sec,
+                'output_tokens': args.output_tokens,
+                'failure_rate': args.failure_rate
+            },
+            seed=args.seed
+        ))
+
+    start = time.perf_counter()
+    if args.scenario == 'single':
+        results = bench_single(config, args.requests)
+    elif args.scenario == 'multi':
+        results = bench_multi(config, args.requests)
+    else:
+        results = asyncio.run(bench_concurrent(config, args.requests, args.concurrency))
+    report = {'scenario': args.scenario, **summarize(results, time.perf_counter() - start)}
+
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+    main()
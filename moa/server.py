@@ -0,0 +1,259 @@
+"""
+Streaming HTTP server exposing MOAgent as an OpenAI-compatible chat completions endpoint
+
+The server is stateless: every request carries its full message history, and
+one compiled MOAgent is shared by all requests. Streaming responses use
+Server-Sent Events; layer agent outputs are sent as ``moa.intermediate`` events
+ahead of the standard ``chat.completion.chunk`` data events, which OpenAI
+clients ignore.
+
+Usage:
+    python -m moa.server --config moa_config.json --port 8000 --max-concurrency 64
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage, convert_to_messages
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.types import Receive, Scope, Send
+
+from moa.agent import MOAgent
+from moa.agent.moa import MOAgentConfig, ResponseChunk
+
+
+class ChatService:
+    """Admission control around a shared MOAgent.
+
+    At most ``max_concurrency`` requests run at once and up to ``max_queue`` more
+    wait for a slot; anything beyond that is rejected with 429 right away.
+    """
+
+    def __init__(self, agent: MOAgent, model: str, max_concurrency: int = 64, max_queue: int = 256) -> None:
+        self.agent = agent
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.admitted = 0
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    def try_admit(self) -> bool:
+        if self.admitted >= self.max_concurrency + self.max_queue:
+            return False
+        self.admitted += 1
+        return True
+
+    def release(self) -> None:
+        self.admitted -= 1
+
+    @staticmethod
+    def history(messages: List[Dict[str, Any]]) -> List[BaseMessage]:
+        """Parse a request's ``messages``, raising ``ValueError`` if they can't be answered."""
+        try:
+            history = convert_to_messages(messages)
+        except (NotImplementedError, TypeError) as e:
+            raise ValueError(f"Invalid messages: {e}") from e
+        if not history or history[-1].type != 'human':
+            raise ValueError("The last message must come from the user")
+        return history
+
+    async def run(self, history: List[BaseMessage], cycles: Optional[int]) -> AsyncIterator[ResponseChunk]:
+        async with self._slots:
+            async for chunk in self.agent.achat(
+                history[-1].content,
+                messages=history[:-1],
+                cycles=cycles,
+                save=False,
+                output_format='json',
+                stream_layers=True
+            ):
+                yield chunk
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """Streaming response releasing its admission slot once sent.
+
+    Starlette doesn't start the body iterator if the client is gone before the
+    headers are sent, so the slot is released here rather than by the body.
+    """
+
+    def __init__(self, content: AsyncIterator[str], service: ChatService, **kwargs: Any) -> None:
+        super().__init__(content, **kwargs)
+        self.service = service
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.service.release()
+
+
+def sse(data: Dict[str, Any] | str, event: Optional[str] = None) -> str:
+    payload = data if isinstance(data, str) else json.dumps(data)
+    return (f"event: {event}\n" if event else "") + f"data: {payload}\n\n"
+
+
+def completion_chunk(completion_id: str, model: str, created: int, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        'id': completion_id,
+        'object': 'chat.completion.chunk',
+        'created': created,
+        'model': model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+    }
+
+
+def trace_usage(trace: Dict[str, Any]) -> Dict[str, Any]:
+    """OpenAI ``usage`` of a turn, flagged ``estimated`` if some calls reported no usage."""
+    usage = {
+        'prompt_tokens': trace['prompt_tokens'],
+        'completion_tokens': trace['completion_tokens'],
+        'total_tokens': trace['prompt_tokens'] + trace['completion_tokens']
+    }
+    if trace.get('usage_estimated'):
+        usage['estimated'] = True
+    return usage
+
+
+async def stream_completion(service: ChatService, chunks: AsyncIterator[ResponseChunk]) -> AsyncIterator[str]:
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    try:
+        yield sse(completion_chunk(completion_id, service.model, created, {'role': 'assistant'}))
+        async for chunk in chunks:
+            if chunk['response_type'] == 'intermediate':
+                yield sse({'delta': chunk['delta'], **chunk['metadata']}, event='moa.intermediate')
+            elif 'trace' in chunk['metadata']:
+                trace = chunk['metadata']['trace']
+                yield sse(completion_chunk(completion_id, service.model, created, {}, finish_reason='stop') | {
+                    'usage': trace_usage(trace)
+                })
+            elif chunk['delta']:
+                yield sse(completion_chunk(completion_id, service.model, created, {'content': chunk['delta']}))
+    except Exception as e:
+        yield sse({'error': {'message': str(e), 'type': type(e).__name__}}, event='error')
+    finally:
+        await chunks.aclose()
+    yield sse("[DONE]")
+
+
+async def chat_completions(request: Request) -> Response:
+    service: ChatService = request.app.state.service
+    try:
+        body = await request.json()
+        messages = body['messages']
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return JSONResponse({'error': {'message': "Request body must be JSON with 'messages'"}}, status_code=400)
+    try:
+        history = service.history(messages)
+    except ValueError as e:
+        return JSONResponse({'error': {'message': str(e)}}, status_code=400)
+
+    if not service.try_admit():
+        return JSONResponse(
+            {'error': {'message': "Server is at capacity, retry later", 'type': 'rate_limit_exceeded'}},
+            status_code=429,
+            headers={'Retry-After': '1'}
+        )
+    chunks = service.run(history, body.get('cycles'))
+
+    if body.get('stream'):
+        # Starlette only sends the next event once the previous one was written, so a
+        # slow client pauses the agent instead of buffering its output; on disconnect
+        # the generator is closed, which stops the agent.
+        return AdmittedStreamingResponse(
+            stream_completion(service, chunks),
+            service,
+            media_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    content, layers, usage = "", [], {}
+    try:
+        async for chunk in chunks:
+            if chunk['response_type'] == 'intermediate':
+                layers.append({'delta': chunk['delta'], **chunk['metadata']})
+            elif 'trace' in chunk['metadata']:
+                usage = trace_usage(chunk['metadata']['trace'])
+            else:
+                content += chunk['delta']
+    finally:
+        await chunks.aclose()
+        service.release()
+
+    return JSONResponse({
+        'id': f"chatcmpl-{uuid.uuid4().hex}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': service.model,
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop'
+        }],
+        'usage': usage,
+        'moa': {'intermediate': layers}
+    })
+
+
+async def list_models(request: Request) -> Response:
+    service: ChatService = request.app.state.service
+    return JSONResponse({'object': 'list', 'data': [{'id': service.model, 'object': 'model', 'owned_by': 'moa'}]})
+
+
+async def health(request: Request) -> Response:
+    service: ChatService = request.app.state.service
+    return JSONResponse({'status': 'ok', 'in_flight': service.admitted})
+
+
+def create_app(
+    config: Dict[str, Any],
+    max_concurrency: int = 64,
+    max_queue: int = 256
+) -> Starlette:
+    agent_kwargs = MOAgentConfig(**config).model_dump(exclude_unset=True)
+    agent = MOAgent.from_config(**agent_kwargs)
+    app = Starlette(routes=[
+        Route('/v1/chat/completions', chat_completions, methods=['POST']),
+        Route('/v1/models', list_models, methods=['GET']),
+        Route('/health', health, methods=['GET']),
+    ])
+    app.state.service = ChatService(
+        agent,
+        model=agent_kwargs.get('main_model') or 'moa',
+        max_concurrency=max_concurrency,
+        max_queue=max_queue
+    )
+    return app
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', help="MoA configuration JSON (MOAgentConfig fields)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-concurrency', type=int, default=64, help="Requests processed at once")
+    parser.add_argument('--max-queue', type=int, default=256, help="Requests waiting for a slot before 429s")
+    args = parser.parse_args(argv)
+
+    config: Dict[str, Any] = {'cycles': 1}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+
+    import uvicorn
+    uvicorn.run(
+        create_app(config, max_concurrency=args.max_concurrency, max_queue=args.max_queue),
+        host=args.host,
+        port=args.port
+    )
+
+
+if __name__ == '__main__':
+    main()